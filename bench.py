@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Đo thông lượng và độ trễ của pipeline tạo ảnh với API VMOS giả lập (fake_vmos.py), không cần Discord hay điểm thật.
+
+Ví dụ: python bench.py --jobs 200 --accounts 10 --profile realistic --time-scale 0.1 --unique-prompts 50
+"""
+import argparse, asyncio, json, logging, os, random, time, types
+from datetime import datetime, timezone
+
+os.environ.setdefault('PROMPT_CACHE_BACKEND', 'memory'); os.environ.setdefault('METRICS_PORT', '0')
+import aiohttp
+import bot as vmos
+from fake_vmos import FakeVMOS, PROFILES, start_server
+
+def check_view(view, allow_none=False):
+    """Cùng kiểu kiểm tra như discord.py: followup.send không nhận view=None, message.edit thì có (để xóa view)."""
+    if not (view is vmos.discord.utils.MISSING or isinstance(view, vmos.discord.ui.View) or (allow_none and view is None)): raise TypeError(f"expected view parameter to be of type View, not {view.__class__.__name__}")
+
+class FakeMessage:
+    def __init__(self, interaction): self.interaction = interaction
+    async def edit(self, embed=None, embeds=None, view=vmos.discord.utils.MISSING):
+        check_view(view, allow_none=True)
+        if embed or embeds: self.interaction.record(embed or embeds[0])
+
+class FakeFollowup:
+    def __init__(self, interaction): self.interaction = interaction
+    async def send(self, content=None, embed=None, embeds=None, view=vmos.discord.utils.MISSING, wait=False, **kwargs):
+        check_view(view)
+        if embed or embeds: self.interaction.record(embed or embeds[0])
+        return FakeMessage(self.interaction)
+
+class FakeInteraction:
+    """Đủ thuộc tính mà generation_worker dùng; ghi lại thời điểm người dùng nhận kết quả cuối cùng."""
+    def __init__(self, user_id: int):
+        self.user = types.SimpleNamespace(id=user_id, display_name=f"bench-{user_id}", display_avatar=types.SimpleNamespace(url='https://fake-vmos.local/avatar.png'))
+        self.followup = FakeFollowup(self); self.created_at = datetime.now(timezone.utc); self.sent_at = time.monotonic(); self.finished_at = None; self.succeeded = None
+    def record(self, embed):
+        if embed.title and embed.title[0] in "✅❌": self.finished_at = time.monotonic(); self.succeeded = embed.title.startswith("✅")
+
+def configure(args, api_base: str):
+    vmos.Config.API_BASE_URL = api_base; vmos.Config.SHORTENER_URL = api_base.rsplit('/vcpcloud/api', 1)[0] + '/api-create.php'
+    vmos.Config.MAX_JOBS_PER_ACCOUNT = args.jobs_per_account
+    for name in ('POLL_MIN_INTERVAL', 'POLL_FAST_INTERVAL', 'POLL_MAX_INTERVAL', 'POLL_TIMEOUT'): setattr(vmos.Config, name, getattr(vmos.Config, name) * args.time_scale)
+    # Không gọi Google Translate: prompt giả lập không phải tiếng Anh thông dụng nên sẽ bị đem đi dịch qua mạng
+    async def translate(text): return text
+    vmos.translation_service.translate = translate; vmos.translation_service.peek = lambda text: text
+    manager = vmos.account_manager
+    manager.accounts = [{'token': f'bench-token-{i}', 'userId': str(900000 + i), 'description': f'Bench #{i + 1}'} for i in range(args.accounts)]
+    manager.points = {}; manager.in_flight = {}; manager.submitted = {}; manager.current_index = 0
+
+async def run(args):
+    fake = FakeVMOS(args.profile, args.time_scale, vmos.Config.POINTS_PER_IMAGE, seed=args.seed)
+    runner, api_base = await start_server(fake); configure(args, api_base)
+    bot = vmos.bot; bot.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=180))
+    bot.wait_until_ready = lambda: asyncio.sleep(0); bot.is_closed = lambda: False
+    bot.poller.start(asyncio.get_running_loop()); vmos.prompt_cache.start(asyncio.get_running_loop()); bot.start_workers()
+    interactions = []; chooser = random.Random(args.seed); started = time.monotonic()
+    try:
+        for i in range(args.jobs):
+            interaction = FakeInteraction(0 if chooser.random() < args.hot_user_share else i % args.users); interactions.append(interaction)
+            pd = {'prompt': f"benchmark prompt number {i % args.unique_prompts}", 'style': 'Không có', 'negative_prompt': None, 'size': '1024x1024', 'guidance_scale': 7.5, 'seed': -1}
+            await bot.generation_queue.put({'interaction': interaction, 'prompt_details': pd, 'enqueued_at': time.monotonic()})
+            if args.rate: await asyncio.sleep(1 / args.rate)
+        await bot.generation_queue.join()
+        while any(it.finished_at is None for it in interactions) and time.monotonic() - started < vmos.Config.POLL_TIMEOUT * 2: await asyncio.sleep(0.05)
+    finally:
+        elapsed = time.monotonic() - started
+        for task in bot.workers: task.cancel()
+        bot.poller.stop(); await vmos.prompt_cache.close(); await bot.session.close(); await runner.cleanup()
+    return report(args, fake, interactions, elapsed)
+
+def report(args, fake: FakeVMOS, interactions: list, elapsed: float):
+    latencies = [it.finished_at - it.sent_at for it in interactions if it.finished_at is not None]; per_user = {}
+    for it in interactions:
+        if it.finished_at is not None: per_user.setdefault(it.user.id, []).append(it.finished_at - it.sent_at)
+    succeeded = sum(1 for it in interactions if it.succeeded); api_calls = sum(v for k, v in fake.calls.items() if k != 'shorten')
+    return {
+        'profile': args.profile, 'jobs': args.jobs, 'accounts': args.accounts, 'jobs_per_account': args.jobs_per_account, 'time_scale': args.time_scale,
+        'succeeded': succeeded, 'failed': len(interactions) - succeeded, 'wall_seconds': round(elapsed, 3),
+        'jobs_per_min': round(len(latencies) / elapsed * 60, 2) if elapsed else 0.0,
+        'latency_p50': round(vmos.percentile(latencies, 50) or 0, 3), 'latency_p99': round(vmos.percentile(latencies, 99) or 0, 3),
+        'latency_p99_by_user': {user_id: round(vmos.percentile(values, 99), 3) for user_id, values in sorted(per_user.items())},
+        'api_calls': fake.calls, 'api_calls_per_image': round(api_calls / succeeded, 2) if succeeded else None,
+        'images_generated': len(fake.tasks), 'cache': vmos.prompt_cache.stats(), 'poller': vmos.bot.poller.stats(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pipeline tạo ảnh với API VMOS giả lập.')
+    parser.add_argument('--jobs', type=int, default=100); parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--jobs-per-account', type=int, default=1); parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--unique-prompts', type=int, default=10 ** 9, help='Số prompt khác nhau (nhỏ hơn --jobs để đo cache/gộp yêu cầu).')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='fast'); parser.add_argument('--time-scale', type=float, default=1.0, help='Nhân mọi độ trễ giả lập và chu kỳ poll với hệ số này.')
+    parser.add_argument('--hot-user-share', type=float, default=0, help='Tỷ lệ job đến từ một người dùng "spam" (user 0) để đo độ công bằng.')
+    parser.add_argument('--rate', type=float, default=0, help='Số job gửi mỗi giây (0 = gửi tất cả cùng lúc).'); parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='In kết quả dạng JSON.')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(run(args))
+    if args.json: print(json.dumps(result, ensure_ascii=False, indent=2)); return
+    print(f"📊 {result['jobs']} job | {result['accounts']} tài khoản x {result['jobs_per_account']} | profile {result['profile']} (time scale {result['time_scale']})")
+    print(f"   Thành công: {result['succeeded']} | Lỗi: {result['failed']} | Thời gian: {result['wall_seconds']}s | Thông lượng: {result['jobs_per_min']} job/phút")
+    print(f"   Độ trễ p50: {result['latency_p50']}s | p99: {result['latency_p99']}s | p99 theo người dùng: {result['latency_p99_by_user']}")
+    print(f"   API: {result['api_calls']} | {result['api_calls_per_image']} lần gọi/ảnh | Ảnh tạo thật: {result['images_generated']} | Cache trúng: {result['cache']['hits']}")
+
+if __name__ == "__main__":
+    main()
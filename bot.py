@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
-import asyncio, aiohttp, discord, json, logging, os, re, time
+import asyncio, aiohttp, contextvars, discord, heapq, itertools, json, logging, math, os, random, re, sqlite3, threading, time, types
+from aiohttp import web
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlsplit
 from discord.ext import commands
 from dotenv import load_dotenv
 from googletrans import Translator
@@ -13,10 +18,92 @@ logger = logging.getLogger(__name__)
 class Config:
     DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
     OWNER_ID = 1370417047070048276 # ID của discord của bạn
-    API_BASE_URL = 'https://api.vmoscloud.com/vcpcloud/api'
+    API_BASE_URL = os.getenv('VMOS_API_BASE_URL', 'https://api.vmoscloud.com/vcpcloud/api')
+    SHORTENER_URL = os.getenv('SHORTENER_URL', 'http://tinyurl.com/api-create.php')
+    SHORTENER_TIMEOUT = 3 # Timeout (giây) cho mỗi lần rút gọn link; quá hạn thì giữ link gốc
+    MAX_BUTTON_URL_LENGTH = 512 # Giới hạn độ dài URL của nút link trên Discord
     POINTS_PER_IMAGE = 1000
     ACCOUNTS_FILE = 'accounts.json'
-    PROMPT_CACHE_FILE = 'prompt_cache.json'
+    PROMPT_CACHE_BACKEND = os.getenv('PROMPT_CACHE_BACKEND', 'sqlite') # 'sqlite' hoặc 'memory'
+    PROMPT_CACHE_DB = 'prompt_cache.db'
+    PROMPT_CACHE_MAX_ENTRIES = 200000 # Số prompt tối đa trong cache, vượt quá sẽ xóa các mục lâu không dùng nhất
+    PROMPT_CACHE_FLUSH_INTERVAL = 2 # Chu kỳ (giây) ghi các thay đổi của cache theo lô
+    PROMPT_CACHE_EXPIRY_MARGIN = 600 # Coi URL đã hết hạn sớm hơn số giây này để tránh trả về link sắp chết
+    SIMILAR_PROMPT_THRESHOLD = 0.8 # Độ giống (Jaccard trên tập từ) tối thiểu để dùng lại ảnh của prompt gần giống
+    SIMILARITY_INDEX_SIZE = 50000 # Số prompt gần dùng nhất được đưa vào chỉ mục tìm prompt gần giống
+    TRANSLATION_MEMO_FILE = 'translation_memo.json'
+    TRANSLATION_MEMO_SIZE = 5000 # Số bản dịch tối đa giữ trong bộ nhớ và trên đĩa (LRU)
+    TRANSLATION_TIMEOUT = 10 # Timeout (giây) cho mỗi lần gọi Google Translate
+    TRANSLATION_FLUSH_INTERVAL = 30 # Chu kỳ (giây) ghi bộ nhớ dịch xuống đĩa
+    MAX_JOBS_PER_ACCOUNT = int(os.getenv('MAX_JOBS_PER_ACCOUNT', 1)) # Số job chạy song song tối đa trên mỗi tài khoản
+    POINTS_TTL = 300 # Số giây trước khi điểm trong sổ điểm được coi là cũ
+    POINTS_REFRESH_INTERVAL = 60 # Chu kỳ (giây) kiểm tra và làm mới sổ điểm ở nền
+    POINTS_ERROR_TTL = 5 # Số giây trước khi thử lại một tài khoản mà lần lấy điểm trước bị lỗi
+    POLL_TIMEOUT = 180 # Thời gian tối đa (giây) chờ một taskId hoàn thành
+    POLL_MIN_INTERVAL = 2.0 # Chu kỳ poll khi chưa có dữ liệu lịch sử
+    POLL_FAST_INTERVAL = 1.0 # Chu kỳ poll trong khoảng thời gian ảnh thường hoàn thành
+    POLL_MAX_INTERVAL = 10.0 # Chu kỳ poll tối đa khi backoff
+    POLL_REQUEST_TIMEOUT = 15 # Timeout (giây) cho mỗi lần gọi API trạng thái
+    POLL_HISTORY_SIZE = 200 # Số mẫu thời gian hoàn thành giữ lại cho mỗi kích thước ảnh
+    MAX_PENDING_PER_USER = int(os.getenv('MAX_PENDING_PER_USER', 3)) # Số yêu cầu đang chờ + đang chạy tối đa của mỗi người dùng (chủ bot không bị giới hạn)
+    MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 100)) # Số yêu cầu chờ tối đa của cả hàng đợi
+    QUEUE_STATE_FILE = 'queue_state.json' # Lưu các yêu cầu chưa xong để chạy tiếp sau khi khởi động lại
+    QUEUE_STATE_FLUSH_INTERVAL = 2 # Chu kỳ (giây) ghi trạng thái hàng đợi xuống đĩa
+    INTERACTION_TOKEN_TTL = 840 # Token interaction của Discord sống 15 phút; job chỉ được gửi đi tạo ảnh khi token còn sống hơn POLL_TIMEOUT trước mốc này
+    DEFAULT_JOB_SECONDS = 20 # Thời gian một ảnh dùng để ước tính ETA khi chưa có dữ liệu
+    MAX_BATCH_SIZE = 4 # Số ảnh tối đa trong một yêu cầu /generate count hoặc /batch (một gallery Discord hiển thị tối đa 4 ảnh)
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 9108)) # Cổng HTTP cho endpoint /metrics, đặt 0 để tắt
+    TRACE_JOBS = os.getenv('TRACE_JOBS', '0') == '1' # Ghi log thời gian từng bước của mỗi job
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class Metrics:
+    """Counter/histogram/gauge kiểu Prometheus giữ trong bộ nhớ, xuất ra định dạng text cho endpoint /metrics."""
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180)
+    def __init__(self): self.counters = {}; self.histograms = {}; self.gauges = {}
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items()))); self.counters[key] = self.counters.get(key, 0) + value
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        hist = self.histograms.setdefault(key, {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0, 'recent': deque(maxlen=500)})
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound: hist['buckets'][i] += 1
+        hist['sum'] += value; hist['count'] += 1; hist['recent'].append(value)
+    def gauge(self, name: str, fn): self.gauges[name] = fn
+    @contextmanager
+    def timer(self, stage: str):
+        """Đo thời gian một bước vào `vmos_stage_seconds` và ghi vào trace của job hiện tại (nếu bật TRACE_JOBS)."""
+        start = time.perf_counter()
+        try: yield
+        finally:
+            elapsed = time.perf_counter() - start; self.observe('vmos_stage_seconds', elapsed, stage=stage)
+            if (trace := current_trace.get()) is not None: trace.append((stage, elapsed))
+    def stage_summary(self):
+        return {dict(labels).get('stage'): {'count': h['count'], 'p50': percentile(h['recent'], 50), 'p95': percentile(h['recent'], 95)} for (name, labels), h in sorted(self.histograms.items()) if name == 'vmos_stage_seconds'}
+    def counter_total(self, name: str, **labels):
+        return sum(v for (n, lbls), v in self.counters.items() if n == name and all((k, str(val)) in lbls for k, val in labels.items()))
+    def render(self):
+        fmt = lambda labels: "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+        lines = []
+        for name in sorted({n for n, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter"); lines += [f"{name}{fmt(labels)} {v}" for (n, labels), v in sorted(self.counters.items()) if n == name]
+        for name in sorted({n for n, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), h in sorted(self.histograms.items()):
+                if n != name: continue
+                lines += [f"{name}_bucket{fmt(labels + (('le', f'{b:g}'),))} {c}" for b, c in zip(self.BUCKETS, h['buckets'])]
+                lines += [f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {h['count']}", f"{name}_sum{fmt(labels)} {h['sum']}", f"{name}_count{fmt(labels)} {h['count']}"]
+        for name, fn in sorted(self.gauges.items()): lines += [f"# TYPE {name} gauge", f"{name} {fn()}"]
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def percentile(values, q: float):
+    if not values: return None
+    ordered = sorted(values); return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+def format_duration(seconds: float):
+    return f"{max(1, round(seconds))} giây" if seconds < 90 else f"{round(seconds / 60)} phút"
 
 def is_owner():
     def predicate(interaction: discord.Interaction) -> bool:
@@ -26,11 +113,14 @@ def is_owner():
 class AccountManager:
     def __init__(self, file_path=Config.ACCOUNTS_FILE):
         self.file_path = file_path; self.accounts = []; self.current_index = -1
+        self.in_flight = {}; self.submitted = {}; self.lease_changed = asyncio.Condition()
+        self.points = {}; self.refresh_lock = asyncio.Lock()
         self.reload()
     def reload(self):
         try:
             with open(self.file_path, 'r', encoding='utf-8') as f: self.accounts = json.load(f)
             if not self.accounts or not isinstance(self.accounts, list): raise ValueError("File rỗng hoặc không hợp lệ.")
+            keys = {self.account_key(acc) for acc in self.accounts}; self.points = {k: v for k, v in self.points.items() if k in keys}
             self.current_index = 0; logger.info(f"✅ Đã tải lại thành công {len(self.accounts)} tài khoản."); return True
         except FileNotFoundError: logger.error(f"❌ LỖI: Không tìm thấy file {self.file_path}."); self.accounts = []; return False
         except Exception as e: logger.error(f"❌ Lỗi khi đọc file accounts.json: {e}"); self.accounts = []; return False
@@ -42,129 +132,676 @@ class AccountManager:
         self.current_index = (self.current_index + 1) % len(self.accounts)
         logger.warning(f"🔄 Đã chuyển sang tài khoản: {self.get_current_account().get('description', f'#{self.current_index}')}")
         return self.get_current_account()
+    def account_key(self, account): return str(account.get('userId'))
+    def has_free_slot(self, account): return self.in_flight.get(self.account_key(account), 0) < Config.MAX_JOBS_PER_ACCOUNT
+    def get_points(self, account): return self.points.get(self.account_key(account), {}).get('points', 0)
+    def available_points(self, account):
+        """Điểm trong sổ trừ phần giữ chỗ cho các job đã nhận tài khoản nhưng chưa gửi yêu cầu tạo ảnh (job đã gửi thì đã bị trừ)."""
+        key = self.account_key(account); return self.get_points(account) - (self.in_flight.get(key, 0) - self.submitted.get(key, 0)) * Config.POINTS_PER_IMAGE
+    def is_stale(self, account):
+        entry = self.points.get(self.account_key(account))
+        return not entry or time.monotonic() - entry['updated_at'] > (Config.POINTS_ERROR_TTL if entry['error'] else Config.POINTS_TTL)
+    async def refresh_points(self, fetch_points, accounts=None, force=False, refreshed_before=None):
+        """Cập nhật sổ điểm (mặc định: mọi tài khoản đã quá TTL; `force` để làm mới kể cả khi còn hạn, `refreshed_before` để làm mới các mục cập nhật trước mốc đó), gọi API song song."""
+        async with self.refresh_lock:
+            targets = [acc for acc in (self.accounts if accounts is None else accounts) if force or self.is_stale(acc) or (refreshed_before is not None and self.points[self.account_key(acc)]['updated_at'] < refreshed_before)]
+            if not targets: return
+            results = await asyncio.gather(*(fetch_points(acc) for acc in targets)); now = time.monotonic()
+            for acc, res in zip(targets, results):
+                self.points[self.account_key(acc)] = {'points': res.get('points', 0) if res.get('success') else 0, 'error': None if res.get('success') else res.get('error'), 'updated_at': now}
+            logger.info(f"💎 Đã cập nhật điểm của {len(targets)} tài khoản.")
+        async with self.lease_changed: self.lease_changed.notify_all()
+    def invalidate(self, account):
+        """Đánh dấu điểm của tài khoản là cũ; lần giữ chỗ kế tiếp sẽ hỏi lại API trước khi chọn tài khoản này."""
+        if (entry := self.points.get(self.account_key(account))): entry['updated_at'] = 0
+    def _pick_account(self):
+        candidates = [(i, acc) for i, acc in enumerate(self.accounts) if self.has_free_slot(acc) and self.available_points(acc) >= Config.POINTS_PER_IMAGE]
+        if not candidates: return None
+        return min(candidates, key=lambda c: (self.in_flight.get(self.account_key(c[1]), 0), -self.available_points(c[1])))
+    async def lease_account(self, fetch_points):
+        """Giữ chỗ tài khoản rảnh nhất / nhiều điểm nhất theo sổ điểm; chờ nếu mọi tài khoản còn điểm đều đang bận."""
+        started_at = time.monotonic()
+        while True:
+            if not self.accounts: raise Exception("Không có tài khoản nào được cấu hình.")
+            if (stale := [acc for acc in self.accounts if self.is_stale(acc)]): await self.refresh_points(fetch_points, stale)
+            if (picked := self._pick_account()):
+                i, acc = picked; key = self.account_key(acc)
+                if i != self.current_index: metrics.inc('vmos_account_switches_total')
+                self.in_flight[key] = self.in_flight.get(key, 0) + 1; self.current_index = i
+                return acc
+            if all(self.get_points(acc) < Config.POINTS_PER_IMAGE for acc in self.accounts):
+                failed = [acc for acc in self.accounts if self.points[self.account_key(acc)]['error']]
+                if any(self.points[self.account_key(acc)]['updated_at'] < started_at for acc in failed): await self.refresh_points(fetch_points, failed, refreshed_before=started_at); continue
+                if failed: raise Exception(f"Không kiểm tra được điểm của {len(failed)}/{len(self.accounts)} tài khoản ({self.points[self.account_key(failed[0])]['error']})" + (", các tài khoản còn lại đã hết điểm." if len(failed) < len(self.accounts) else ". Vui lòng thử lại sau."))
+                raise Exception("Tất cả các tài khoản đều đã hết điểm.")
+            async with self.lease_changed:
+                if not self._pick_account(): await self.lease_changed.wait()
+    def debit(self, account):
+        """Trừ điểm ngay khi API nhận yêu cầu tạo ảnh, để lần làm mới sổ điểm sau đó (đã gồm khoản trừ này) không bị trừ lặp."""
+        key = self.account_key(account); self.submitted[key] = self.submitted.get(key, 0) + 1
+        if key in self.points: self.points[key]['points'] -= Config.POINTS_PER_IMAGE
+    async def release_account(self, account, submitted=False):
+        key = self.account_key(account)
+        if self.in_flight.get(key, 0) > 0: self.in_flight[key] -= 1
+        if submitted and self.submitted.get(key, 0) > 0: self.submitted[key] -= 1
+        async with self.lease_changed: self.lease_changed.notify_all()
 
 account_manager = AccountManager()
 #--cache--
+def parse_url_expiry(url: str):
+    """Trả về thời điểm (epoch) mà URL ký sẵn (TOS/S3) hết hạn, hoặc None nếu URL không có thông tin hết hạn."""
+    query = {k.lower(): v for k, v in parse_qsl(urlsplit(url).query)}
+    for prefix in ('x-tos-', 'x-amz-'):
+        if (signed_at := query.get(f'{prefix}date')) and (expires := query.get(f'{prefix}expires')):
+            try: return datetime.strptime(signed_at, '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc).timestamp() + int(expires)
+            except ValueError: return None
+    return float(query['expires']) if query.get('expires', '').isdigit() else None
+
+class SQLiteCacheBackend:
+    """Lưu cache trong SQLite (WAL). Đọc trên event loop bằng một kết nối riêng, ghi theo lô trong thread khác."""
+    def __init__(self, file_path=Config.PROMPT_CACHE_DB):
+        self.file_path = file_path; self.reader = self._connect()
+        self.reader.executescript("""
+            CREATE TABLE IF NOT EXISTS prompt_cache (key TEXT PRIMARY KEY, url TEXT NOT NULL, expires_at REAL, last_used REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS prompt_cache_last_used ON prompt_cache (last_used);
+            CREATE INDEX IF NOT EXISTS prompt_cache_expires_at ON prompt_cache (expires_at);
+            CREATE TABLE IF NOT EXISTS short_links (long_url TEXT PRIMARY KEY, short_url TEXT NOT NULL, expires_at REAL);
+            CREATE INDEX IF NOT EXISTS short_links_expires_at ON short_links (expires_at);""")
+        self.writer = self._connect()
+    def _connect(self):
+        conn = sqlite3.connect(self.file_path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL'); conn.execute('PRAGMA synchronous=NORMAL'); return conn
+    def get(self, key: str):
+        row = self.reader.execute('SELECT url, expires_at FROM prompt_cache WHERE key = ?', (key,)).fetchone()
+        return tuple(row) if row else None
+    def get_short_url(self, long_url: str):
+        row = self.reader.execute('SELECT short_url, expires_at FROM short_links WHERE long_url = ?', (long_url,)).fetchone()
+        return tuple(row) if row else None
+    def count(self): return self.reader.execute('SELECT COUNT(*) FROM prompt_cache').fetchone()[0]
+    def recent_keys(self, limit: int): return [row[0] for row in self.reader.execute('SELECT key FROM prompt_cache ORDER BY last_used DESC LIMIT ?', (limit,))]
+    def write_batch(self, upserts: dict, touches: dict, deletes: set, short_links: dict, max_entries: int, now: float):
+        with self.writer:
+            self.writer.execute('BEGIN')
+            self.writer.executemany('INSERT OR REPLACE INTO prompt_cache (key, url, expires_at, last_used) VALUES (?, ?, ?, ?)', [(k, *v) for k, v in upserts.items()])
+            self.writer.executemany('UPDATE prompt_cache SET last_used = ? WHERE key = ?', [(t, k) for k, t in touches.items()])
+            self.writer.executemany('DELETE FROM prompt_cache WHERE key = ?', [(k,) for k in deletes])
+            self.writer.execute('DELETE FROM prompt_cache WHERE expires_at IS NOT NULL AND expires_at < ?', (now,))
+            self.writer.executemany('INSERT OR REPLACE INTO short_links (long_url, short_url, expires_at) VALUES (?, ?, ?)', [(k, *v) for k, v in short_links.items()])
+            self.writer.execute('DELETE FROM short_links WHERE expires_at IS NOT NULL AND expires_at < ?', (now,))
+            if upserts and (overflow := self.writer.execute('SELECT COUNT(*) FROM prompt_cache').fetchone()[0] - max_entries) > 0:
+                self.writer.execute('DELETE FROM prompt_cache WHERE key IN (SELECT key FROM prompt_cache ORDER BY last_used LIMIT ?)', (overflow,))
+    def close(self): self.reader.close(); self.writer.close()
+
+class MemoryCacheBackend:
+    """Cache chỉ nằm trong bộ nhớ (mất khi khởi động lại) — dùng cho thử nghiệm."""
+    def __init__(self): self.rows = OrderedDict(); self.short_links = {}
+    def get(self, key: str):
+        row = self.rows.get(key)
+        return row[:2] if row else None
+    def get_short_url(self, long_url: str): return self.short_links.get(long_url)
+    def count(self): return len(self.rows)
+    def recent_keys(self, limit: int): return list(reversed(self.rows))[:limit]
+    def write_batch(self, upserts: dict, touches: dict, deletes: set, short_links: dict, max_entries: int, now: float):
+        self.short_links.update(short_links)
+        for key in [k for k, (_, expires_at) in self.short_links.items() if expires_at is not None and expires_at < now]: del self.short_links[key]
+        for key, row in upserts.items(): self.rows[key] = row; self.rows.move_to_end(key)
+        for key in touches:
+            if key in self.rows: self.rows.move_to_end(key)
+        for key in deletes: self.rows.pop(key, None)
+        for key in [k for k, (_, expires_at, _) in self.rows.items() if expires_at is not None and expires_at < now]: del self.rows[key]
+        while len(self.rows) > max_entries: self.rows.popitem(last=False)
+    def close(self): pass
+
+PROMPT_ARTICLES = {'a', 'an', 'the'}
+PROMPT_STOPWORDS = PROMPT_ARTICLES | {'of', 'and', 'with', 'in', 'on', 'at', 'is', 'are'} # Chỉ bỏ khi tìm prompt gần giống (reuse_similar)
+def canonical_tokens(text: str | None):
+    """Tách prompt thành danh sách từ đã chuẩn hóa cho khóa chính xác: chữ thường, bỏ dấu câu và mạo từ, không phụ thuộc thứ tự."""
+    return sorted(t for t in re.findall(r'[^\W_]+', (text or '').lower()) if t not in PROMPT_ARTICLES)
+def build_cache_key(prompt: str, negative_prompt: str | None, style: str, size: str, guidance_scale: float, seed: int):
+    """Khóa cache dạng `prompt|negative|style|size|guidance|seed`; seed -1 được ghi là `random`."""
+    return "|".join([" ".join(canonical_tokens(prompt)), " ".join(canonical_tokens(negative_prompt)), style, size, f"{float(guidance_scale):g}", str(seed) if seed != -1 else "random"])
+def split_cache_key(key: str):
+    """Tách khóa thành (tập từ của prompt đã bỏ từ phổ biến, phần phải khớp chính xác trừ seed, seed); None nếu khóa không đúng định dạng."""
+    parts = key.split("|")
+    return (frozenset(parts[0].split()) - PROMPT_STOPWORDS, "|".join(parts[1:5]), parts[5]) if len(parts) == 6 else None
+
+class SimilarityIndex:
+    """Chỉ mục ngược từ → khóa cache để tìm prompt gần giống (Jaccard) bằng lọc tiền tố: chỉ duyệt danh sách của các từ hiếm nhất."""
+    def __init__(self, max_entries=Config.SIMILARITY_INDEX_SIZE):
+        self.max_entries = max_entries; self.entries = OrderedDict(); self.postings = {}
+    def add(self, key: str):
+        if not (parsed := split_cache_key(key)) or not parsed[0]: return
+        self.remove(key); self.entries[key] = parsed
+        for token in parsed[0]: self.postings.setdefault((parsed[1], token), set()).add(key)
+        while len(self.entries) > self.max_entries: self.remove(next(iter(self.entries)))
+    def remove(self, key: str):
+        if not (parsed := self.entries.pop(key, None)): return
+        for token in parsed[0]:
+            if (keys := self.postings.get((parsed[1], token))) is not None:
+                keys.discard(key)
+                if not keys: del self.postings[(parsed[1], token)]
+    def query(self, key: str, threshold: float):
+        """Trả về danh sách (độ giống, khóa) có độ giống >= threshold, giống nhất trước; khóa seed `random` khớp với ảnh của mọi seed."""
+        if not (parsed := split_cache_key(key)) or not parsed[0]: return []
+        tokens, bucket, seed = parsed; rarest = sorted(tokens, key=lambda t: len(self.postings.get((bucket, t), ())))
+        prefix = rarest[:len(tokens) - math.ceil(threshold * len(tokens)) + 1]
+        candidates = set().union(*(self.postings.get((bucket, t), ()) for t in prefix)) - {key}
+        scored = [(len(tokens & other) / len(tokens | other), k) for k in candidates if seed in ('random', self.entries[k][2]) and (other := self.entries[k][0])]
+        return sorted((item for item in scored if item[0] >= threshold), reverse=True)
+
+CACHE_BACKENDS = {'sqlite': SQLiteCacheBackend, 'memory': MemoryCacheBackend}
+
 class PromptCache:
-    def __init__(self, file_path=Config.PROMPT_CACHE_FILE):
-        self.file_path = file_path; self.cache = self._load()
+    """Cache prompt → URL ảnh. Bỏ qua URL đã hết hạn, ghi theo lô ở nền và giới hạn kích thước theo LRU."""
+    def __init__(self, backend=None):
+        self.backend = backend or CACHE_BACKENDS[Config.PROMPT_CACHE_BACKEND]()
+        self.upserts = {}; self.flushing = {}; self.touches = {}; self.deletes = set(); self.short_links = {}; self.flushing_links = {}; self.task = None; self.hits = self.misses = self.expired = self.similar_hits = 0
+        self.index = SimilarityIndex()
+        for key in reversed(self.backend.recent_keys(Config.SIMILARITY_INDEX_SIZE)): self.index.add(key)
+    def _lookup(self, prompt_key: str, now: float):
+        row = self.upserts.get(prompt_key) or self.flushing.get(prompt_key) or (None if prompt_key in self.deletes else self.backend.get(prompt_key))
+        if not row: self.index.remove(prompt_key); return None
+        url, expires_at = row[:2]
+        if expires_at is not None and expires_at - Config.PROMPT_CACHE_EXPIRY_MARGIN < now:
+            self.expired += 1; self.upserts.pop(prompt_key, None); self.deletes.add(prompt_key); self.index.remove(prompt_key); return None
+        self.touches[prompt_key] = now; return url
+    def get(self, prompt_key: str, similar_threshold: float | None = None):
+        """Tra cache theo khóa (seed ngẫu nhiên thì nhận ảnh cùng prompt của seed bất kỳ); nếu có `similar_threshold` thì khi trượt sẽ thử các prompt gần giống đủ ngưỡng."""
+        now = time.time()
+        for key in self.exact_keys(prompt_key):
+            if (url := self._lookup(key, now)): self.hits += 1; metrics.inc('vmos_cache_lookups_total', result='hit'); return url
+        if similar_threshold is not None:
+            for similarity, key in self.index.query(prompt_key, similar_threshold):
+                if (url := self._lookup(key, now)): self.similar_hits += 1; metrics.inc('vmos_cache_lookups_total', result='similar'); logger.info(f"🔎 Dùng lại ảnh của prompt gần giống ({similarity:.0%})."); return url
+        self.misses += 1; metrics.inc('vmos_cache_lookups_total', result='miss'); return None
+    def exact_keys(self, prompt_key: str):
+        """Khóa của chính prompt, cộng thêm khóa cùng prompt/tùy chọn với seed cụ thể nếu yêu cầu dùng seed ngẫu nhiên."""
+        if not prompt_key.endswith("|random"): return [prompt_key]
+        return [prompt_key, *(key for _, key in self.index.query(prompt_key, 1.0) if key.rsplit("|", 1)[0] == prompt_key.rsplit("|", 1)[0])]
+    def contains(self, prompt_key: str):
+        """Có ảnh còn hạn cho khóa trong cache không (không tính vào thống kê trúng/trượt)."""
+        for key in self.exact_keys(prompt_key):
+            row = self.upserts.get(key) or self.flushing.get(key) or (None if key in self.deletes else self.backend.get(key))
+            if row and (row[1] is None or row[1] - Config.PROMPT_CACHE_EXPIRY_MARGIN >= time.time()): return True
+        return False
+    def set(self, prompt_key: str, image_url: str):
+        now = time.time(); expires_at = parse_url_expiry(image_url)
+        if expires_at is not None and expires_at - Config.PROMPT_CACHE_EXPIRY_MARGIN < now: return
+        self.upserts[prompt_key] = (image_url, expires_at, now); self.deletes.discard(prompt_key); self.index.add(prompt_key)
+    def get_short_url(self, long_url: str):
+        row = self.short_links.get(long_url) or self.flushing_links.get(long_url) or self.backend.get_short_url(long_url)
+        return row[0] if row and (row[1] is None or row[1] > time.time()) else None
+    def set_short_url(self, long_url: str, short_url: str): self.short_links[long_url] = (short_url, parse_url_expiry(long_url))
+    def stats(self):
+        lookups = self.hits + self.similar_hits + self.misses
+        return {'hits': self.hits, 'similar_hits': self.similar_hits, 'misses': self.misses, 'expired': self.expired, 'hit_rate': (self.hits + self.similar_hits) / lookups if lookups else 0.0, 'pending_writes': len(self.upserts) + len(self.touches) + len(self.deletes)}
+    def start(self, loop): self.task = loop.create_task(self.flush_loop())
+    async def flush(self):
+        if not (self.upserts or self.touches or self.deletes or self.short_links): return
+        upserts, touches, deletes, short_links = self.upserts, self.touches, self.deletes, self.short_links; self.flushing, self.flushing_links = upserts, short_links
+        self.upserts, self.touches, self.deletes, self.short_links = {}, {}, set(), {}
+        try: await asyncio.to_thread(self.backend.write_batch, upserts, touches, deletes, short_links, Config.PROMPT_CACHE_MAX_ENTRIES, time.time())
+        except Exception as e: logger.error(f"❌ Không thể ghi cache: {e}"); self.upserts = {**upserts, **self.upserts}; self.short_links = {**short_links, **self.short_links}
+        finally: self.flushing, self.flushing_links = {}, {}
+    async def flush_loop(self):
+        while True: await asyncio.sleep(Config.PROMPT_CACHE_FLUSH_INTERVAL); await self.flush()
+    async def close(self):
+        if self.task: self.task.cancel()
+        await self.flush(); self.backend.close()
+
+prompt_cache = PromptCache()
+
+class TranslationService:
+    """Dịch prompt sang tiếng Anh ngoài event loop, có bộ nhớ LRU + file (văn bản gốc → (ngôn ngữ, bản dịch))."""
+    PASSTHROUGH_LANGS = ['en', 'zh-cn', 'zh-tw']
+    # Từ tiếng Anh thường gặp trong prompt; bỏ các từ trùng với tiếng Việt không dấu (an, to, do, me, ...) để không nhận nhầm.
+    ENGLISH_WORDS = frozenset('the of and with in on at is are for from by under over into near very beautiful cute girl boy woman man cat dog city night light lights sky sunset sea forest mountain portrait style art anime realistic photo detailed high quality dark red blue green white black gold golden wearing holding standing sitting running flying dress hair eyes face smile flower flowers tree house car street rain snow fire water moon sun star stars dragon castle robot future futuristic cyberpunk fantasy magic background landscape painting illustration'.split())
+    def __init__(self, file_path=Config.TRANSLATION_MEMO_FILE):
+        self.file_path = file_path; self.memo = self._load(); self.in_flight = {}; self.dirty = False; self.task = None; self.local = threading.local()
     def _load(self):
-        if not os.path.exists(self.file_path): return {}
+        if not os.path.exists(self.file_path): return OrderedDict()
         try:
-            with open(self.file_path, 'r', encoding='utf-8') as f: return json.load(f)
-        except (json.JSONDecodeError, IOError): return {}
-    def _save(self):
+            with open(self.file_path, 'r', encoding='utf-8') as f: return OrderedDict(list(json.load(f).items())[-Config.TRANSLATION_MEMO_SIZE:])
+        except (json.JSONDecodeError, IOError, AttributeError): return OrderedDict()
+    def _save(self, snapshot):
         try:
-            with open(self.file_path, 'w', encoding='utf-8') as f: json.dump(self.cache, f, indent=2, ensure_ascii=False)
-        except IOError as e: logger.error(f"❌ Không thể ghi file cache: {e}")
-    def get(self, prompt_key: str): return self.cache.get(prompt_key)
-    def set(self, prompt_key: str, image_url: str): self.cache[prompt_key] = image_url; self._save()
+            with open(self.file_path, 'w', encoding='utf-8') as f: json.dump(snapshot, f, ensure_ascii=False)
+        except IOError as e: logger.error(f"❌ Không thể ghi file bộ nhớ dịch: {e}")
+    def start(self, loop): self.task = loop.create_task(self.flush_loop())
+    async def flush(self):
+        if not self.dirty: return
+        self.dirty = False; await asyncio.to_thread(self._save, dict(self.memo))
+    async def flush_loop(self):
+        while True: await asyncio.sleep(Config.TRANSLATION_FLUSH_INTERVAL); await self.flush()
+    async def close(self):
+        if self.task: self.task.cancel()
+        await self.flush()
+    def remember(self, text: str, lang: str, english: str):
+        self.memo[text] = [lang, english]; self.memo.move_to_end(text); self.dirty = True
+        while len(self.memo) > Config.TRANSLATION_MEMO_SIZE: self.memo.popitem(last=False)
+    def _translate_blocking(self, text: str):
+        if not hasattr(self.local, 'translator'): self.local.translator = Translator()
+        result = self.local.translator.translate(text, dest='en')
+        return result.src.lower(), (text if result.src.lower() in self.PASSTHROUGH_LANGS else result.text)
+    async def _translate(self, text: str):
+        try: lang, english = await asyncio.wait_for(asyncio.to_thread(self._translate_blocking, text), Config.TRANSLATION_TIMEOUT)
+        except Exception as e: logger.warning(f"⚠️ Không dịch được prompt, dùng nguyên bản: {e!r}"); return text
+        self.remember(text, lang, english); return english
+    def looks_english(self, text: str):
+        """Prompt ASCII mà ít nhất một nửa số từ là từ tiếng Anh thường gặp; tiếng Việt gõ không dấu vẫn đi qua bước dịch."""
+        words = re.findall(r'[a-z]+', text.lower())
+        return text.isascii() and bool(words) and sum(w in self.ENGLISH_WORDS for w in words) * 2 >= len(words)
+    def peek(self, text: str):
+        """Bản dịch đã biết mà không gọi Google Translate; None nếu chưa có trong bộ nhớ dịch."""
+        if not text or self.looks_english(text): return text
+        return hit[1] if (hit := self.memo.get(text)) else None
+    async def translate(self, text: str):
+        if not text or self.looks_english(text): return text
+        if (hit := self.memo.get(text)): self.memo.move_to_end(text); return hit[1]
+        if text not in self.in_flight: self.in_flight[text] = asyncio.ensure_future(self._translate(text)); self.in_flight[text].add_done_callback(lambda _: self.in_flight.pop(text, None))
+        return await asyncio.shield(self.in_flight[text])
 
-prompt_cache = PromptCache()
+translation_service = TranslationService()
+
+class StatusPoller:
+    """Poll chung mọi taskId đang chờ trong một vòng lặp; lịch poll dựa trên thời gian hoàn thành đã quan sát theo kích thước ảnh."""
+    def __init__(self, fetch_status):
+        self.fetch_status = fetch_status; self.pending = {}; self.history = {}; self.durations = deque(maxlen=Config.POLL_HISTORY_SIZE)
+        self.wakeup = asyncio.Event(); self.task = None; self.polls = 0; self.errors = 0; self.timeouts = 0
+    def start(self, loop): self.task = loop.create_task(self.run())
+    def stop(self):
+        for task in [self.task, *(entry.get('polling') for entry in self.pending.values())]:
+            if task: task.cancel()
+    def stats(self):
+        return {'pending': len(self.pending), 'samples': len(self.durations), 'p50': percentile(self.durations, 50), 'p95': percentile(self.durations, 95), 'polls': self.polls, 'errors': self.errors, 'timeouts': self.timeouts}
+    def next_delay(self, entry, elapsed: float):
+        """Poll dày trong khoảng [p10, p95] của lịch sử, chờ tới p10 nếu còn sớm, backoff khi đã quá p95."""
+        history = self.history.get(entry['profile'])
+        if not history or len(history) < 3: return Config.POLL_MIN_INTERVAL
+        low, high = percentile(history, 10), percentile(history, 95)
+        if elapsed < low: return max(Config.POLL_FAST_INTERVAL, low - elapsed)
+        if elapsed < high: return Config.POLL_FAST_INTERVAL
+        entry['backoff'] = min(Config.POLL_MAX_INTERVAL, entry['backoff'] * 1.5); return entry['backoff']
+    async def wait(self, task_id: str, account: dict, profile: str):
+        loop = asyncio.get_running_loop(); now = time.monotonic(); entry = {'account': account, 'profile': profile, 'future': loop.create_future(), 'submitted_at': now, 'backoff': Config.POLL_FAST_INTERVAL, 'errors': 0}
+        entry['next_poll'] = now + self.next_delay(entry, 0); self.pending[task_id] = entry; self.wakeup.set()
+        try: return await entry['future']
+        finally: self.pending.pop(task_id, None)
+    async def poll(self, task_id: str, entry: dict):
+        self.polls += 1; metrics.inc('vmos_status_polls_total')
+        try: result = await self.fetch_status(task_id, entry['account'])
+        except Exception as e:
+            self.errors += 1; metrics.inc('vmos_api_errors_total', endpoint='status', account=entry['account'].get('userId'), code=getattr(e, 'status', type(e).__name__)); entry['errors'] += 1; entry['next_poll'] = time.monotonic() + min(Config.POLL_MAX_INTERVAL, Config.POLL_MIN_INTERVAL * 2 ** (entry['errors'] - 1))
+            logger.warning(f"⚠️ Lỗi khi kiểm tra trạng thái task {task_id} (lần {entry['errors']}), sẽ thử lại: {e}"); return
+        now = time.monotonic(); elapsed = now - entry['submitted_at']
+        if result is None: entry['errors'] = 0; entry['next_poll'] = now + self.next_delay(entry, elapsed); return
+        self.history.setdefault(entry['profile'], deque(maxlen=Config.POLL_HISTORY_SIZE)).append(elapsed); self.durations.append(elapsed); metrics.observe('vmos_time_to_image_seconds', elapsed, size=entry['profile'])
+        if not entry['future'].done(): entry['future'].set_result(result)
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            for task_id, entry in list(self.pending.items()):
+                if not entry['future'].done() and now - entry['submitted_at'] > Config.POLL_TIMEOUT:
+                    self.timeouts += 1; metrics.inc('vmos_poll_timeouts_total'); entry['future'].set_result({'success': False, 'error': 'Image generation timed out.'})
+            for task_id, entry in self.pending.items():
+                if not entry['future'].done() and not entry.get('polling') and entry['next_poll'] <= now:
+                    entry['polling'] = asyncio.create_task(self.poll(task_id, entry)); entry['polling'].add_done_callback(lambda _, entry=entry: (entry.pop('polling', None), self.wakeup.set()))
+            self.wakeup.clear()
+            next_poll = min((deadline for entry in self.pending.values() if not entry['future'].done() for deadline in ([entry['submitted_at'] + Config.POLL_TIMEOUT] if entry.get('polling') else [entry['next_poll']])), default=None)
+            try: await asyncio.wait_for(self.wakeup.wait(), None if next_poll is None else max(0, next_poll - time.monotonic()))
+            except asyncio.TimeoutError: pass
+
+class FairScheduler:
+    """Hàng đợi job thay cho asyncio.Queue: làn ưu tiên, chia lượt công bằng giữa người dùng (deficit round-robin theo số ảnh), giới hạn nhận job, ETA và lưu các job chưa xong xuống file."""
+    LANES = ('owner', 'cache', 'normal') # Làn trước luôn được phục vụ trước làn sau
+    def __init__(self, file_path=Config.QUEUE_STATE_FILE):
+        self.file_path = file_path; self.lanes = {lane: OrderedDict() for lane in self.LANES}; self.deficits = {}; self.size = 0; self.running = {}; self.seq = itertools.count(1)
+        self.not_empty = asyncio.Event(); self.unfinished = 0; self.all_done = asyncio.Event(); self.all_done.set()
+        self.durations = deque(maxlen=Config.POLL_HISTORY_SIZE); self.dirty = False; self.task = None
+    @staticmethod
+    def cost(job: dict): return len(job['batch']) if 'batch' in job else 1
+    def qsize(self): return self.size
+    def user_load(self, user_id: int):
+        return sum(len(users.get(user_id, ())) for users in self.lanes.values()) + sum(1 for job in self.running.values() if job['interaction'].user.id == user_id)
+    def admission_error(self, user_id: int, privileged=False):
+        """Lý do từ chối một job mới, None nếu được nhận."""
+        if privileged: return None
+        if self.user_load(user_id) >= Config.MAX_PENDING_PER_USER: metrics.inc('vmos_queue_rejections_total', reason='user'); return f"Bạn đang có {Config.MAX_PENDING_PER_USER} yêu cầu chờ/đang chạy, hãy đợi chúng xong rồi gửi tiếp."
+        if self.size >= Config.MAX_QUEUE_SIZE: metrics.inc('vmos_queue_rejections_total', reason='global'); return "Hàng đợi đang đầy, vui lòng thử lại sau ít phút."
+        return None
+    async def put(self, job: dict, lane='normal'):
+        job['lane'] = lane; job['seq'] = next(self.seq); job.setdefault('submitted_at', time.time())
+        self.lanes[lane].setdefault(job['interaction'].user.id, deque()).append(job)
+        self.size += 1; self.unfinished += 1; self.all_done.clear(); self.not_empty.set(); self.dirty = True
+    async def get(self):
+        while not self.size: self.not_empty.clear(); await self.not_empty.wait()
+        job = self._pop(self.lanes, self.deficits); self.size -= 1; job['started_at'] = time.monotonic(); self.running[job['seq']] = job; self.dirty = True
+        return job
+    def task_done(self, job: dict):
+        if self.running.pop(job['seq'], None) and 'prompt_details' in job: self.durations.append(time.monotonic() - job['started_at'])
+        self.unfinished -= 1; self.dirty = True
+        if not self.unfinished: self.all_done.set()
+    async def join(self): await self.all_done.wait()
+    @classmethod
+    def _pop(cls, lanes: dict, deficits: dict):
+        """Lấy job kế tiếp của làn cao nhất còn job: mỗi lượt người dùng ở đầu vòng được cộng 1 ảnh vào hạn mức, đủ hạn mức cho job đầu tiên thì chạy."""
+        lane, users = next((lane, users) for lane, users in lanes.items() if users)
+        while True:
+            user_id, jobs = next(iter(users.items())); key = (lane, user_id)
+            if deficits.get(key, 0) >= (cost := cls.cost(jobs[0])):
+                deficits[key] -= cost; job = jobs.popleft()
+                if not jobs: del users[user_id]; deficits.pop(key, None)
+                return job
+            deficits[key] = deficits.get(key, 0) + 1; users.move_to_end(user_id)
+    def order(self):
+        """Thứ tự chạy dự kiến của các job đang chờ nếu không có job mới."""
+        lanes = {lane: OrderedDict((user_id, deque(jobs)) for user_id, jobs in users.items()) for lane, users in self.lanes.items()}; deficits = dict(self.deficits)
+        return [self._pop(lanes, deficits) for _ in range(self.size)]
+    def estimates(self, slots: int):
+        """[(job, vị trí, số giây đến khi xong)]: mô phỏng `slots` slot tài khoản, mỗi ảnh chiếm một slot trong thời gian trung bình của các job gần đây."""
+        now = time.monotonic(); per_image = sum(self.durations) / len(self.durations) if self.durations else Config.DEFAULT_JOB_SECONDS; slots = max(1, slots); free = [0.0] * slots
+        for job in self.running.values():
+            for _ in range(min(self.cost(job), slots)): heapq.heapreplace(free, free[0] + max(0.0, per_image - (now - job['started_at'])))
+        result = []
+        for position, job in enumerate(self.order(), 1):
+            starts = [heapq.heappop(free) for _ in range(min(self.cost(job), slots))]; end = max(starts) + per_image * math.ceil(self.cost(job) / slots)
+            for _ in starts: heapq.heappush(free, end)
+            result.append((job, position, end))
+        return result
+    def estimate(self, job: dict, slots: int):
+        return next(((position, eta) for j, position, eta in self.estimates(slots) if j is job), (None, None))
+    def snapshot(self):
+        """Các job đang chạy (`interrupted`) và đang chờ ở dạng JSON; bỏ qua job không có token interaction để trả kết quả."""
+        jobs = sorted([*self.running.values(), *(job for users in self.lanes.values() for jobs in users.values() for job in jobs)], key=lambda job: job['seq'])
+        return [{'user_id': it.user.id, 'application_id': it.application_id, 'token': it.token, 'created_at': it.created_at.timestamp(), 'lane': job['lane'], 'submitted_at': job['submitted_at'], 'interrupted': job['seq'] in self.running, **{k: job[k] for k in ('prompt_details', 'batch') if k in job}} for job in jobs if getattr(it := job['interaction'], 'token', None)]
+    def load(self):
+        if not os.path.exists(self.file_path): return []
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f: return json.load(f)
+        except (json.JSONDecodeError, IOError): return []
+    def _save(self, snapshot):
+        try:
+            with open(self.file_path, 'w', encoding='utf-8') as f: json.dump(snapshot, f, ensure_ascii=False)
+        except IOError as e: logger.error(f"❌ Không thể ghi trạng thái hàng đợi: {e}")
+    def start(self, loop): self.task = loop.create_task(self.flush_loop())
+    async def flush(self):
+        if not self.dirty: return
+        self.dirty = False; await asyncio.to_thread(self._save, self.snapshot())
+    async def flush_loop(self):
+        while True: await asyncio.sleep(Config.QUEUE_STATE_FLUSH_INTERVAL); await self.flush()
+    async def close(self):
+        if self.task: self.task.cancel()
+        await self.flush()
 
 def get_vmos_headers(account):
     if not account: raise ValueError("Tài khoản không hợp lệ.")
     return {'Accept': 'application/json, text/plain, */*', 'Content-Type': 'application/json', 'Token': account['token'], 'userId': str(account['userId']), 'clientType': 'web', 'appVersion': '2008500', 'requestsource': 'wechat-miniapp', 'SupplierType': '0', 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'}
 STYLE_KEYWORDS = {"Không có": "best quality, masterpiece", "Anime": "anime artwork, anime style, key visual, vibrant, studio anime, highly detailed", "Thực tế (Realistic)": "photorealistic, realistic, 8k, ultra-detailed, professional photography, sharp focus, cinematic photo", "Cyberpunk": "cyberpunk style, neon lights, futuristic city, dystopian, cinematic, blade runner", "Fantasy": "fantasy art, magical, epic, enchanting, detailed matte painting, dungeons and dragons", "Tranh sơn dầu": "oil painting, masterpiece, textured, brush strokes, impressionism"}
+def variant_seed(seed: int, index: int):
+    """Seed cho biến thể thứ `index`: seed cố định thì tăng dần, seed ngẫu nhiên thì bốc một seed cụ thể để các biến thể không trùng khóa cache."""
+    return (seed + index) % 2147483648 if seed != -1 else random.randint(0, 2147483647)
 ASPECT_RATIO_MAP = {"1:1 (Vuông)": "1024x1024", "3:4 (Dọc)": "768x1024", "4:3 (Ngang)": "1024x768", "16:9 (Màn ảnh rộng)": "1344x768", "9:16 (Story)": "768x1344"}
 
 class VMOSAIBot(commands.Bot):
     def __init__(self):
         intents = discord.Intents.default(); intents.message_content = True
         super().__init__(command_prefix=commands.when_mentioned_or("!"), intents=intents, help_command=None)
-        self.session, self.translator = None, Translator(); self.generation_queue = asyncio.Queue(); self.current_job_user = None
+        self.session = None; self.generation_queue = FairScheduler()
+        self.workers = []; self.active_jobs = {}; self.job_ids = itertools.count(1); self.points_task = None; self.pending_generations = {}; self.pending_short_links = {}; self.background_tasks = set()
+        self.poller = StatusPoller(self.fetch_image_status); self.metrics_runner = None
+        metrics.gauge('vmos_queue_depth', self.generation_queue.qsize); metrics.gauge('vmos_active_jobs', lambda: len(self.active_jobs))
+        metrics.gauge('vmos_pending_polls', lambda: len(self.poller.pending)); metrics.gauge('vmos_pending_generations', lambda: len(self.pending_generations))
+        metrics.gauge('vmos_accounts_in_flight', lambda: sum(account_manager.in_flight.values())); metrics.gauge('vmos_queue_users', lambda: len({user_id for users in self.generation_queue.lanes.values() for user_id in users}))
     async def setup_hook(self):
-        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=180)); logger.info("🤖 VMOS AI Bot setup completed"); self.loop.create_task(self.generation_worker())
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=180)); self.poller.start(self.loop); translation_service.start(self.loop); prompt_cache.start(self.loop); logger.info("🤖 VMOS AI Bot setup completed")
+        if Config.METRICS_PORT: await self.start_metrics_server()
+        await self.restore_queue(); self.generation_queue.start(self.loop)
+        if not account_manager.accounts: logger.error("🚫 Worker không thể khởi động vì không có tài khoản nào."); return
+        self.points_task = self.loop.create_task(self.points_refresher()); self.start_workers()
     async def on_ready(self):
         logger.info(f"🎨 {self.user} is online and ready!"); await self.tree.sync()
         activity_name = f"với {len(account_manager.accounts)} tài khoản" if account_manager.accounts else "Lỗi tài khoản"
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=activity_name))
     async def close(self):
+        await self.generation_queue.close()
+        for task in [*self.workers, self.points_task]:
+            if task: task.cancel()
+        self.poller.stop(); await translation_service.close(); await prompt_cache.close()
+        if self.metrics_runner: await self.metrics_runner.cleanup()
         if self.session: await self.session.close(); await super().close()
-    async def generation_worker(self):
-        await self.wait_until_ready();
-        if not account_manager.accounts: logger.error("🚫 Worker không thể khởi động vì không có tài khoản nào."); return
-        logger.info("👷 Generation worker is now running.")
+    async def start_metrics_server(self):
+        async def handle_metrics(request): return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+        app = web.Application(); app.router.add_get('/metrics', handle_metrics)
+        self.metrics_runner = web.AppRunner(app); await self.metrics_runner.setup()
+        try: await web.TCPSite(self.metrics_runner, Config.METRICS_HOST, Config.METRICS_PORT).start(); logger.info(f"📈 Metrics tại http://{Config.METRICS_HOST}:{Config.METRICS_PORT}/metrics")
+        except OSError as e: logger.error(f"❌ Không thể mở cổng metrics {Config.METRICS_PORT}: {e}")
+    def spawn(self, coro):
+        """Chạy một tác vụ nền và giữ tham chiếu tới khi xong để event loop không thu hồi nó giữa chừng."""
+        task = asyncio.create_task(coro); self.background_tasks.add(task); task.add_done_callback(self.background_tasks.discard); return task
+    def start_workers(self):
+        """Đảm bảo số worker bằng tổng số slot của các tài khoản (gọi lại sau khi thêm tài khoản)."""
+        target = max(1, len(account_manager.accounts) * Config.MAX_JOBS_PER_ACCOUNT)
+        self.workers = [w for w in self.workers if not w.done()]
+        while len(self.workers) < target: self.workers.append(asyncio.get_running_loop().create_task(self.generation_worker(len(self.workers) + 1)))
+        logger.info(f"👷 Đang chạy {len(self.workers)} generation worker.")
+    async def restore_queue(self):
+        """Đưa lại vào hàng đợi các job chưa xong của lần chạy trước nếu token interaction còn hạn để gửi kết quả (qua webhook followup)."""
+        restored = expired = interrupted = 0
+        for entry in self.generation_queue.load():
+            if time.time() - entry['created_at'] > Config.INTERACTION_TOKEN_TTL: expired += 1; continue
+            followup = discord.Webhook.from_state({'id': entry['application_id'], 'type': 3, 'token': entry['token']}, self._connection)
+            if entry.get('interrupted'):
+                # Job đang chạy lúc dừng có thể đã bị trừ điểm hoặc đã gửi ảnh, chạy lại có thể tốn điểm và gửi ảnh hai lần
+                interrupted += 1
+                try: await followup.send("⚠️ Bot vừa khởi động lại khi yêu cầu của bạn đang được xử lý. Nếu chưa nhận được ảnh, vui lòng gửi lại lệnh.")
+                except discord.HTTPException as e: logger.warning(f"⚠️ Không báo được cho người dùng về yêu cầu bị gián đoạn: {e}")
+                continue
+            if time.time() > entry['created_at'] + Config.INTERACTION_TOKEN_TTL - Config.POLL_TIMEOUT: expired += 1; continue
+            try: user = self.get_user(entry['user_id']) or await self.fetch_user(entry['user_id'])
+            except discord.HTTPException: expired += 1; continue
+            interaction = types.SimpleNamespace(user=user, application_id=entry['application_id'], token=entry['token'], created_at=datetime.fromtimestamp(entry['created_at'], timezone.utc), followup=followup)
+            job = {'interaction': interaction, 'enqueued_at': time.monotonic() - max(0.0, time.time() - entry['submitted_at']), 'submitted_at': entry['submitted_at'], **{k: entry[k] for k in ('prompt_details', 'batch') if k in entry}}
+            await self.generation_queue.put(job, entry['lane']); restored += 1
+        self.generation_queue.dirty = True
+        if restored or expired or interrupted: logger.info(f"♻️ Khôi phục {restored} yêu cầu chưa xong từ lần chạy trước (bỏ {expired} yêu cầu đã hết hạn token, {interrupted} yêu cầu bị gián đoạn khi đang chạy).")
+    def submit_deadline(self, interaction):
+        """Mốc cuối (epoch) để gửi yêu cầu tạo ảnh mà token interaction vẫn còn sống qua cả thời gian poll tối đa."""
+        return interaction.created_at.timestamp() + Config.INTERACTION_TOKEN_TTL - Config.POLL_TIMEOUT
+    def is_cache_likely(self, pd: dict):
+        """Đoán nhanh (không gọi mạng) job có trúng cache hoặc dùng chung với một job đang chạy không."""
+        prompt = translation_service.peek(self.clean_prompt(pd['prompt'])); negative = translation_service.peek(self.clean_prompt(pd['negative_prompt'])) if pd['negative_prompt'] else None
+        if prompt is None or (pd['negative_prompt'] and negative is None): return False
+        cache_key = build_cache_key(prompt, negative, pd['style'], pd['size'], pd['guidance_scale'], pd['seed'])
+        return cache_key in self.pending_generations or prompt_cache.contains(cache_key)
+    async def enqueue(self, job: dict):
+        """Xếp job vào làn ưu tiên (chủ bot > có thể trúng cache > thường), trả về (vị trí, số giây ước tính đến khi xong)."""
+        lane = 'owner' if job['interaction'].user.id == Config.OWNER_ID else 'cache' if 'prompt_details' in job and self.is_cache_likely(job['prompt_details']) else 'normal'
+        await self.generation_queue.put(job, lane); return self.generation_queue.estimate(job, len(self.workers))
+    async def points_refresher(self):
         while not self.is_closed():
-            job = await self.generation_queue.get(); interaction, pd = job['interaction'], job['prompt_details']
-            self.current_job_user = interaction.user; message = None
+            try: await account_manager.refresh_points(self.get_points)
+            except Exception as e: logger.error(f"❌ Lỗi khi làm mới sổ điểm: {e}")
+            await asyncio.sleep(Config.POINTS_REFRESH_INTERVAL)
+    async def generation_worker(self, worker_id: int):
+        await self.wait_until_ready()
+        logger.info(f"👷 Generation worker #{worker_id} is now running.")
+        while not self.is_closed():
+            job = await self.generation_queue.get(); job_id = next(self.job_ids); started_at = time.monotonic()
+            if 'enqueued_at' in job: metrics.observe('vmos_queue_wait_seconds', started_at - job['enqueued_at'])
+            self.active_jobs[job_id] = {'user': job['interaction'].user, 'account': None, 'started_at': started_at}
+            trace = current_trace.set([]) if Config.TRACE_JOBS else None
             try:
-                cleaned_prompt = self.clean_prompt(pd['prompt']); core_prompt_parts = [cleaned_prompt]
-                if pd['negative_prompt']: core_prompt_parts.append(f"| negative prompt: {self.clean_prompt(pd['negative_prompt'])}")
-                core_prompt_for_cache = await self.translate_prompt(" ".join(core_prompt_parts)); cache_key = f"{core_prompt_for_cache}_{pd['size']}_{pd['guidance_scale']}_{pd['seed']}"
-                cached_url = prompt_cache.get(cache_key)
-                if cached_url:
-                    logger.info(f"✅ Smart Cache Hit!"); success_embed = discord.Embed(title="✅ Tạo ảnh thành công! (từ bộ đệm)", color=0x00FF88); success_embed.add_field(name="📝 Prompt Gốc", value=f"```{cleaned_prompt}```", inline=False); success_embed.set_image(url=cached_url); success_embed.set_footer(text=f"Yêu cầu bởi {interaction.user.display_name} | Bot đã tiết kiệm 1000 điểm!", icon_url=interaction.user.avatar.url)
-                    short_url = await self.shorten_url(cached_url); await interaction.followup.send(embed=success_embed, view=ImageView(short_url)); self.generation_queue.task_done(); self.current_job_user = None; continue
-                final_prompt = self.enhance_prompt(cleaned_prompt, pd['style'], pd['negative_prompt']); translated_final_prompt = await self.translate_prompt(final_prompt)
-                active_account = None; checked_accounts = 0
-                while checked_accounts < len(account_manager.accounts):
-                    current_acc = account_manager.get_current_account()
-                    points_res = await self.get_points(current_acc)
-                    if points_res.get('success') and points_res.get('points', 0) >= Config.POINTS_PER_IMAGE:
-                        active_account = current_acc; break
-                    else: account_manager.switch_to_next_account(); checked_accounts += 1
-                if not active_account: raise Exception("Tất cả các tài khoản đều đã hết điểm.")
+                if time.time() > self.submit_deadline(job['interaction']): metrics.inc('vmos_jobs_expired_total'); logger.warning(f"⌛ Bỏ job #{job_id}: token interaction sắp hết hạn nên không kịp gửi kết quả.")
+                else: await self.process_job(job_id, job)
+            except Exception as e: logger.error(f"❌ Worker #{worker_id} gặp lỗi không mong muốn ở job #{job_id}: {e!r}", exc_info=True)
+            finally:
+                metrics.observe('vmos_job_seconds', time.monotonic() - started_at); self.active_jobs.pop(job_id, None); self.generation_queue.task_done(job)
+                if trace: logger.info(f"🧵 Job #{job_id}: " + ", ".join(f"{stage}={elapsed:.2f}s" for stage, elapsed in current_trace.get())); current_trace.reset(trace)
+    def build_success_embed(self, interaction: discord.Interaction, cleaned_prompt: str, style: str, image_url: str, title="✅ Tạo ảnh thành công!", footer_note=""):
+        success_embed = discord.Embed(title=title, color=0x00FF88); success_embed.add_field(name="📝 Prompt Gốc", value=f"```{cleaned_prompt}```", inline=False)
+        if style != "Không có": success_embed.add_field(name="✨ Phong cách", value=style, inline=True)
+        success_embed.set_image(url=image_url); success_embed.set_footer(text=f"Yêu cầu bởi {interaction.user.display_name}{footer_note}", icon_url=interaction.user.display_avatar.url)
+        return success_embed
+    async def translate_details(self, pd: dict):
+        """Làm sạch và dịch prompt/negative prompt (song song), trả về (prompt gốc đã làm sạch, prompt dịch, negative dịch)."""
+        cleaned_prompt = self.clean_prompt(pd['prompt']); cleaned_negative = self.clean_prompt(pd['negative_prompt']) if pd['negative_prompt'] else None
+        with metrics.timer('translate'): translated_prompt, translated_negative = await asyncio.gather(self.translate_prompt(cleaned_prompt), self.translate_prompt(cleaned_negative))
+        return cleaned_prompt, translated_prompt, translated_negative
+    async def render_image(self, job_id: int, pd: dict, translated_prompt: str, translated_negative: str | None, cache_key: str, on_leased=None, deadline: float | None = None):
+        """Tạo một ảnh qua API (giữ chỗ tài khoản, poll, lưu cache) và chia sẻ kết quả cho các job giống hệt đang chờ."""
+        generation = self.pending_generations[cache_key] = asyncio.get_running_loop().create_future(); active_account = None; submitted = done = False
+        try:
+            with metrics.timer('account_lease'): active_account = await account_manager.lease_account(self.get_points)
+            if deadline is not None and time.time() > deadline:
+                await account_manager.release_account(active_account); active_account = None; metrics.inc('vmos_jobs_expired_total')
+                raise Exception("Yêu cầu đã chờ quá lâu, Discord sẽ không cho gửi kết quả kịp. Vui lòng gửi lại lệnh.")
+            if job_id in self.active_jobs: self.active_jobs[job_id]['account'] = active_account.get('description')
+            if on_leased: await on_leased(active_account)
+            with metrics.timer('generate_image'): gen_result = await self.generate_image(self.enhance_prompt(translated_prompt, pd['style'], translated_negative), active_account, pd['size'], pd['guidance_scale'], pd['seed'])
+            if not gen_result.get('success'): raise Exception(f"{gen_result.get('error')}")
+            account_manager.debit(active_account); submitted = True
+            with metrics.timer('poll'): status_result = await self.check_image_status(gen_result['task_id'], active_account, pd['size'])
+            if not status_result.get('success'): raise Exception(f"{status_result.get('error')}")
+            images = status_result.get('images', [])
+            if not images or not images[0]: raise Exception("API không trả về ảnh.")
+            image_url = images[0]; done = True; prompt_cache.set(cache_key, image_url); generation.set_result(image_url); metrics.inc('vmos_images_total', source='generated'); logger.info(f"💾 Đã lưu kết quả vào cache.")
+            return image_url
+        except Exception as e:
+            if active_account and not done: account_manager.invalidate(active_account)
+            if not generation.done(): generation.set_exception(e); generation.exception()
+            metrics.inc('vmos_images_total', source='error'); raise
+        finally:
+            if active_account: await account_manager.release_account(active_account, submitted=submitted)
+            if not generation.done(): generation.cancel()
+            if self.pending_generations.get(cache_key) is generation: del self.pending_generations[cache_key]
+    async def process_job(self, job_id: int, job: dict):
+        if 'batch' in job: return await self.process_batch_job(job_id, job)
+        interaction, pd = job['interaction'], job['prompt_details']; message = None
+        try:
+            cleaned_prompt, translated_prompt, translated_negative = await self.translate_details(pd)
+            cache_key = build_cache_key(translated_prompt, translated_negative, pd['style'], pd['size'], pd['guidance_scale'], pd['seed'])
+            cached_url = prompt_cache.get(cache_key, Config.SIMILAR_PROMPT_THRESHOLD if pd.get('reuse_similar') else None)
+            if cached_url:
+                logger.info(f"✅ Smart Cache Hit!"); success_embed = self.build_success_embed(interaction, cleaned_prompt, pd['style'], cached_url, title="✅ Tạo ảnh thành công! (từ bộ đệm)", footer_note=f" | Bot đã tiết kiệm {Config.POINTS_PER_IMAGE} điểm!")
+                metrics.inc('vmos_images_total', source='cache'); await self.deliver_result(interaction, {'Tải ảnh gốc': cached_url}, embed=success_embed); return
+            if (pending := self.pending_generations.get(cache_key)):
+                metrics.inc('vmos_images_total', source='shared'); logger.info(f"🔗 Job #{job_id} dùng chung kết quả với một yêu cầu giống hệt đang chạy."); self.spawn(self.attach_to_generation(interaction, pd, cleaned_prompt, pending)); return
+            async def show_progress(active_account):
+                nonlocal message
                 embed = discord.Embed(title="🎨 Đang xử lý...", color=discord.Color.gold()); embed.set_footer(text=f"Sử dụng tài khoản: {active_account.get('description')}")
-                message = await interaction.followup.send(embed=embed, wait=True)
-                gen_result = await self.generate_image(translated_final_prompt, active_account, pd['size'], pd['guidance_scale'], pd['seed'])
-                if not gen_result.get('success'): raise Exception(f"{gen_result.get('error')}")
-                task_id = gen_result['task_id']
-                status_result = await self.check_image_status(task_id, active_account)
-                if not status_result.get('success'): raise Exception(f"{status_result.get('error')}")
-                images = status_result.get('images', [])
-                if not images or not images[0]: raise Exception("API không trả về ảnh.")
-                image_url = images[0]; prompt_cache.set(cache_key, image_url); logger.info(f"💾 Đã lưu kết quả vào cache.")
-                short_url = await self.shorten_url(image_url)
-                success_embed = discord.Embed(title="✅ Tạo ảnh thành công!", color=0x00FF88); success_embed.add_field(name="📝 Prompt Gốc", value=f"```{cleaned_prompt}```", inline=False)
-                if pd['style'] != "Không có": success_embed.add_field(name="✨ Phong cách", value=pd['style'], inline=True)
-                success_embed.set_image(url=image_url); success_embed.set_footer(text=f"Yêu cầu bởi {interaction.user.display_name}", icon_url=interaction.user.avatar.url)
-                await message.edit(embed=success_embed, view=ImageView(short_url))
-            except Exception as e:
-                logger.error(f"Error processing job: {e}", exc_info=False)
-                error_embed = discord.Embed(title="❌ Tạo ảnh thất bại", description=str(e), color=0xFF4444)
-                if message: await message.edit(embed=error_embed, view=None)
-                else: await interaction.followup.send(embed=error_embed)
-            finally: self.current_job_user = None; self.generation_queue.task_done()
+                with metrics.timer('discord_followup'): message = await interaction.followup.send(embed=embed, wait=True)
+            image_url = await self.render_image(job_id, pd, translated_prompt, translated_negative, cache_key, on_leased=show_progress, deadline=self.submit_deadline(interaction))
+            await self.deliver_result(interaction, {'Tải ảnh gốc': image_url}, message, embed=self.build_success_embed(interaction, cleaned_prompt, pd['style'], image_url))
+        except Exception as e:
+            logger.error(f"Error processing job #{job_id}: {e}", exc_info=False)
+            error_embed = discord.Embed(title="❌ Tạo ảnh thất bại", description=str(e), color=0xFF4444)
+            if message: await message.edit(embed=error_embed, view=None)
+            else: await interaction.followup.send(embed=error_embed)
+    async def process_batch_job(self, job_id: int, job: dict):
+        """Tạo nhiều ảnh cho một yêu cầu: dịch mỗi prompt khác nhau một lần, chạy song song trên các tài khoản và trả về một gallery."""
+        interaction, batch = job['interaction'], job['batch']; message = None
+        try:
+            embed = discord.Embed(title=f"🎨 Đang tạo {len(batch)} ảnh...", color=discord.Color.gold()); message = await interaction.followup.send(embed=embed, wait=True)
+            distinct = {(pd['prompt'], pd['negative_prompt']): pd for pd in batch}
+            translations = dict(zip(distinct, await asyncio.gather(*(self.translate_details(pd) for pd in distinct.values()))))
+            async def render(pd: dict):
+                cleaned_prompt, translated_prompt, translated_negative = translations[(pd['prompt'], pd['negative_prompt'])]
+                cache_key = build_cache_key(translated_prompt, translated_negative, pd['style'], pd['size'], pd['guidance_scale'], pd['seed'])
+                if (cached_url := prompt_cache.get(cache_key, Config.SIMILAR_PROMPT_THRESHOLD if pd.get('reuse_similar') else None)): metrics.inc('vmos_images_total', source='cache'); return cached_url
+                if (pending := self.pending_generations.get(cache_key)): metrics.inc('vmos_images_total', source='shared'); return await asyncio.shield(pending)
+                return await self.render_image(job_id, pd, translated_prompt, translated_negative, cache_key, deadline=self.submit_deadline(interaction))
+            results = await asyncio.gather(*(render(pd) for pd in batch), return_exceptions=True)
+            images = [(i, url) for i, url in enumerate(results, 1) if isinstance(url, str)]
+            errors = [f"Ảnh {i}: {e}" for i, e in enumerate(results, 1) if not isinstance(e, str)]
+            if not images: raise Exception("\n".join(errors))
+            await self.deliver_result(interaction, {f"Ảnh {i}": url for i, url in images}, message, embeds=self.build_gallery_embeds(interaction, batch, images, errors))
+        except Exception as e:
+            logger.error(f"Error processing batch job #{job_id}: {e}", exc_info=False)
+            error_embed = discord.Embed(title="❌ Tạo ảnh thất bại", description=str(e)[:4096], color=0xFF4444)
+            if message: await message.edit(embed=error_embed, view=None)
+            else: await interaction.followup.send(embed=error_embed)
+    def build_gallery_embeds(self, interaction: discord.Interaction, batch: list, images: list, errors: list):
+        """Các embed cùng `url` được Discord gộp thành một gallery; embed đầu chứa thông tin chung."""
+        gallery_url = images[0][1]; prompts = list(dict.fromkeys(self.clean_prompt(pd['prompt']) for pd in batch))
+        main_embed = discord.Embed(title=f"✅ Đã tạo {len(images)}/{len(batch)} ảnh!", url=gallery_url, color=0x00FF88)
+        main_embed.add_field(name="📝 Prompt Gốc", value="\n".join(f"```{p}```" for p in prompts)[:1024], inline=False)
+        if batch[0]['style'] != "Không có": main_embed.add_field(name="✨ Phong cách", value=batch[0]['style'], inline=True)
+        if errors: main_embed.add_field(name="⚠️ Lỗi", value="\n".join(errors)[:1024], inline=False)
+        main_embed.set_image(url=images[0][1]); main_embed.set_footer(text=f"Yêu cầu bởi {interaction.user.display_name}", icon_url=interaction.user.display_avatar.url)
+        return [main_embed] + [discord.Embed(url=gallery_url).set_image(url=url) for _, url in images[1:]]
+    async def attach_to_generation(self, interaction: discord.Interaction, pd: dict, cleaned_prompt: str, generation: asyncio.Future):
+        """Chờ kết quả của một job giống hệt đang chạy thay vì tốn thêm điểm và thời gian tạo lại."""
+        message = None
+        try:
+            embed = discord.Embed(title="🎨 Đang xử lý...", description="Một yêu cầu giống hệt đang được tạo, ảnh sẽ được dùng chung.", color=discord.Color.gold())
+            message = await interaction.followup.send(embed=embed, wait=True)
+            image_url = await asyncio.shield(generation)
+            await self.deliver_result(interaction, {'Tải ảnh gốc': image_url}, message, embed=self.build_success_embed(interaction, cleaned_prompt, pd['style'], image_url, footer_note=f" | Bot đã tiết kiệm {Config.POINTS_PER_IMAGE} điểm!"))
+        except asyncio.CancelledError:
+            if not generation.cancelled(): raise
+            error = "Yêu cầu giống hệt đã bị hủy."
+        except Exception as e: error = str(e)
+        else: return
+        error_embed = discord.Embed(title="❌ Tạo ảnh thất bại", description=error, color=0xFF4444)
+        if message: await message.edit(embed=error_embed, view=None)
+        else: await interaction.followup.send(embed=error_embed)
     def enhance_prompt(self, prompt: str, style: str, negative_prompt: str | None) -> str:
         style_keywords = STYLE_KEYWORDS.get(style, ''); enhanced_prompt = f"{prompt}, {style_keywords}" if style_keywords else prompt
         if negative_prompt: final_prompt = f"{enhanced_prompt} | negative prompt: {self.clean_prompt(negative_prompt)}"
         else: final_prompt = enhanced_prompt
         return re.sub(r',\s*,', ',', final_prompt).strip(', ')
+    async def deliver_result(self, interaction: discord.Interaction, downloads: dict, message=None, **content):
+        """Gửi (hoặc sửa) embed kết quả ngay với link đã rút gọn sẵn hoặc link gốc; nút tải được cập nhật ở nền khi rút gọn xong."""
+        links = {label: prompt_cache.get_short_url(url) or url for label, url in downloads.items()}
+        with metrics.timer('discord_followup'):
+            if message: await message.edit(**content, view=download_view(links))
+            else: message = await interaction.followup.send(**content, view=download_view(links), wait=True)
+        if (missing := {label: url for label, url in downloads.items() if links[label] == url}): self.spawn(self.upgrade_download_links(message, links, missing))
+        return message
+    async def upgrade_download_links(self, message, links: dict, missing: dict):
+        shortened = dict(zip(missing, await asyncio.gather(*(self.shorten_url(url) for url in missing.values()))))
+        if shortened == missing: return
+        try: await message.edit(view=download_view({**links, **shortened}))
+        except discord.HTTPException as e: logger.warning(f"⚠️ Không cập nhật được link rút gọn: {e}")
     async def shorten_url(self, long_url: str):
-        try:
-            async with self.session.get(f"http://tinyurl.com/api-create.php?url={long_url}") as r:
-                if r.status == 200: return await r.text()
-        except: pass
+        """Rút gọn link (nhớ kết quả cùng cache prompt, gộp các lần gọi trùng); lỗi hoặc quá SHORTENER_TIMEOUT thì trả về link gốc."""
+        if (short_url := prompt_cache.get_short_url(long_url)): return short_url
+        if long_url not in self.pending_short_links:
+            self.pending_short_links[long_url] = asyncio.ensure_future(self._shorten_url(long_url)); self.pending_short_links[long_url].add_done_callback(lambda _: self.pending_short_links.pop(long_url, None))
+        return await asyncio.shield(self.pending_short_links[long_url])
+    async def _shorten_url(self, long_url: str):
+        with metrics.timer('shorten_url'):
+            try:
+                async with self.session.get(Config.SHORTENER_URL, params={'url': long_url}, timeout=aiohttp.ClientTimeout(total=Config.SHORTENER_TIMEOUT)) as r:
+                    if r.status == 200 and (short_url := (await r.text()).strip()).startswith('http'): prompt_cache.set_short_url(long_url, short_url); return short_url
+                    metrics.inc('vmos_shortener_errors_total', code=r.status)
+            except Exception as e: metrics.inc('vmos_shortener_errors_total', code=type(e).__name__); logger.warning(f"⚠️ Không rút gọn được link: {e!r}")
         return long_url
-    async def translate_prompt(self, text: str):
-        try:
-            if self.translator.detect(text).lang not in ['en', 'zh-cn', 'zh-tw']: return self.translator.translate(text, dest='en').text
-        except: pass
-        return text
+    async def translate_prompt(self, text: str | None): return await translation_service.translate(text)
     async def generate_image(self, prompt: str, account: dict, size: str, guidance_scale: float, seed: int):
         payload = {'prompt': prompt, 'size': size, 'seed': seed, 'guidance_scale': guidance_scale};
         async with self.session.post(f"{Config.API_BASE_URL}/images/generation", json=payload, headers=get_vmos_headers(account)) as r:
             data = await r.json();
             if r.status == 200 and data.get('code') == 200 and (td := data.get('data')): return {'success': True, 'task_id': td.get('taskId')}
+            metrics.inc('vmos_api_errors_total', endpoint='generation', account=account.get('userId'), code=data.get('code', r.status))
             return {'success': False, 'error': data.get('msg', f'HTTP {r.status}')}
-    async def check_image_status(self, task_id: str, account: dict):
-        url = f"{Config.API_BASE_URL}/images/status/{task_id}";
-        for _ in range(90):
-            await asyncio.sleep(2)
-            try:
-                async with self.session.get(url, headers=get_vmos_headers(account)) as r:
-                    if r.status == 200 and (d := await r.json()).get('code') == 200 and (rd := d.get('data')): return {'success': True, 'images': json.loads(rd.get('returnImage', '[]'))}
-            except: pass
-        return {'success': False, 'error': 'Image generation timed out.'}
+    async def check_image_status(self, task_id: str, account: dict, size: str):
+        return await self.poller.wait(task_id, account, size)
+    async def fetch_image_status(self, task_id: str, account: dict):
+        """Gọi API trạng thái một lần: trả về kết quả nếu ảnh đã xong, None nếu chưa xong, raise nếu lỗi (có thể thử lại)."""
+        async with self.session.get(f"{Config.API_BASE_URL}/images/status/{task_id}", headers=get_vmos_headers(account), timeout=aiohttp.ClientTimeout(total=Config.POLL_REQUEST_TIMEOUT)) as r:
+            if r.status != 200: raise Exception(f"HTTP {r.status}")
+            if (d := await r.json()).get('code') == 200 and (rd := d.get('data')): return {'success': True, 'images': json.loads(rd.get('returnImage', '[]'))}
+            return None
     async def get_points(self, account: dict):
         url = f"{Config.API_BASE_URL}/imagesUser/userInfo"
         try:
             async with self.session.post(url, json={}, headers=get_vmos_headers(account)) as r:
                 data = await r.json()
                 if r.status == 200 and data.get('code') == 200 and (ud := data.get('data')): return {'success': True, 'points': ud.get('remainingPoints', 0)}
+            metrics.inc('vmos_api_errors_total', endpoint='userInfo', account=account.get('userId'), code=data.get('code', r.status))
             return {'success': False, 'error': data.get('msg', 'API Error')}
-        except Exception as e: return {'success': False, 'error': str(e)}
+        except Exception as e: metrics.inc('vmos_api_errors_total', endpoint='userInfo', account=account.get('userId'), code=type(e).__name__); return {'success': False, 'error': str(e)}
     def clean_prompt(self, prompt: str): return re.sub(r'\s+', ' ', prompt.strip())
 
 bot = VMOSAIBot()
@@ -186,7 +823,7 @@ class AddAccountModal(discord.ui.Modal, title='Thêm tài khoản VMOS mới'):
             new_account = {"token": token, "userId": user_id, "description": desc if desc else f"Tài khoản #{len(accounts_data) + 1}"}
             accounts_data.append(new_account)
             with open(Config.ACCOUNTS_FILE, 'w', encoding='utf-8') as f: json.dump(accounts_data, f, indent=2, ensure_ascii=False)
-            account_manager.reload()
+            account_manager.reload(); bot.start_workers()
             activity_name = f"với {len(account_manager.accounts)} tài khoản"
             await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name=activity_name))
             await interaction.response.send_message(f"✅ Đã thêm thành công! Bot hiện quản lý **{len(accounts_data)}** tài khoản.", ephemeral=True)
@@ -214,9 +851,14 @@ class EditAccountModal(discord.ui.Modal, title='Chỉnh sửa tài khoản VMOS'
         except Exception as e: await interaction.response.send_message(f"❌ Lỗi khi cập nhật file: {e}", ephemeral=True)
 
 class ImageView(discord.ui.View):
-    def __init__(self, download_url: str):
+    def __init__(self, download_urls: dict):
         super().__init__(timeout=300)
-        self.add_item(discord.ui.Button(label='Tải ảnh gốc', style=discord.ButtonStyle.link, emoji='📥', url=download_url))
+        for label, url in download_urls.items(): self.add_item(discord.ui.Button(label=label, style=discord.ButtonStyle.link, emoji='📥', url=url))
+
+def download_view(links: dict):
+    """Nút tải cho các link đủ ngắn để Discord chấp nhận; MISSING (không gửi view) nếu chưa có link nào dùng được, vì followup.send không nhận view=None."""
+    usable = {label: url for label, url in links.items() if len(url) <= Config.MAX_BUTTON_URL_LENGTH}
+    return ImageView(usable) if usable else discord.utils.MISSING
 
 @bot.tree.command(name='addaccount', description='(Chủ bot) Thêm một tài khoản VMOS mới.')
 @is_owner()
@@ -254,22 +896,43 @@ async def remove_account_autocomplete(interaction: discord.Interaction, current:
     return [app_commands.Choice(name=choice, value=choice) for choice in choices if current.lower() in choice.lower()][:25]
 
 @bot.tree.command(name='generate', description='Tạo ảnh AI với đầy đủ tùy chọn chuyên nghiệp.')
-@app_commands.describe(prompt='Mô tả chính của ảnh.',style='Chọn một phong cách nghệ thuật.',negative_prompt='Những thứ bạn KHÔNG muốn thấy trong ảnh.',aspect_ratio='Chọn tỷ lệ khung hình cho ảnh.',guidance_scale='Mức độ bám sát prompt (thấp = sáng tạo, cao = bám sát).',seed='Sử dụng một hạt giống cụ thể để tái tạo ảnh (-1 là ngẫu nhiên).')
-async def generate_command(interaction: discord.Interaction, prompt: str, style: Literal["Không có", "Anime", "Thực tế (Realistic)", "Cyberpunk", "Fantasy", "Tranh sơn dầu"] = "Không có", aspect_ratio: Literal["1:1 (Vuông)", "3:4 (Dọc)", "4:3 (Ngang)", "16:9 (Màn ảnh rộng)", "9:16 (Story)"] = "1:1 (Vuông)", negative_prompt: str = None, guidance_scale: app_commands.Range[float, 1.0, 10.0] = 7.5, seed: app_commands.Range[int, -1, 2147483647] = -1):
+@app_commands.describe(prompt='Mô tả chính của ảnh.',style='Chọn một phong cách nghệ thuật.',negative_prompt='Những thứ bạn KHÔNG muốn thấy trong ảnh.',aspect_ratio='Chọn tỷ lệ khung hình cho ảnh.',guidance_scale='Mức độ bám sát prompt (thấp = sáng tạo, cao = bám sát).',seed='Sử dụng một hạt giống cụ thể để tái tạo ảnh (-1 là ngẫu nhiên).',reuse_similar='Cho phép dùng lại ảnh của một prompt gần giống trong bộ đệm để trả kết quả ngay.',count='Số biến thể cần tạo (mỗi ảnh một seed khác nhau, tốn điểm cho từng ảnh).')
+async def generate_command(interaction: discord.Interaction, prompt: str, style: Literal["Không có", "Anime", "Thực tế (Realistic)", "Cyberpunk", "Fantasy", "Tranh sơn dầu"] = "Không có", aspect_ratio: Literal["1:1 (Vuông)", "3:4 (Dọc)", "4:3 (Ngang)", "16:9 (Màn ảnh rộng)", "9:16 (Story)"] = "1:1 (Vuông)", negative_prompt: str = None, guidance_scale: app_commands.Range[float, 1.0, 10.0] = 7.5, seed: app_commands.Range[int, -1, 2147483647] = -1, reuse_similar: bool = False, count: app_commands.Range[int, 1, Config.MAX_BATCH_SIZE] = 1):
     await interaction.response.defer(ephemeral=True)
     if not account_manager.accounts: await interaction.followup.send("❌ Bot chưa được cấu hình."); return
-    queue_position = bot.generation_queue.qsize() + 1
-    job = {'interaction': interaction, 'prompt_details': {'prompt': prompt, 'style': style, 'negative_prompt': negative_prompt, 'size': ASPECT_RATIO_MAP[aspect_ratio], 'guidance_scale': guidance_scale, 'seed': seed}}
-    await bot.generation_queue.put(job)
-    await interaction.followup.send(f"✅ Yêu cầu của bạn đã vào hàng đợi ở vị trí **#{queue_position}**.")
+    if (error := bot.generation_queue.admission_error(interaction.user.id, privileged=interaction.user.id == Config.OWNER_ID)): await interaction.followup.send(f"❌ {error}"); return
+    pd = {'prompt': prompt, 'style': style, 'negative_prompt': negative_prompt, 'size': ASPECT_RATIO_MAP[aspect_ratio], 'guidance_scale': guidance_scale, 'seed': seed, 'reuse_similar': reuse_similar}
+    if count == 1: job = {'interaction': interaction, 'prompt_details': pd, 'enqueued_at': time.monotonic()}
+    else: job = {'interaction': interaction, 'batch': [{**pd, 'seed': variant_seed(seed, i)} for i in range(count)], 'enqueued_at': time.monotonic()}
+    position, eta = await bot.enqueue(job)
+    await interaction.followup.send(f"✅ Yêu cầu của bạn đã vào hàng đợi ở vị trí **#{position}**, dự kiến xong sau khoảng **{format_duration(eta)}**.")
+
+@bot.tree.command(name='batch', description='Tạo nhiều ảnh từ nhiều prompt cùng lúc, trả về trong một gallery.')
+@app_commands.describe(prompts=f'Các prompt, phân tách bằng dấu chấm phẩy ";" (tối đa {Config.MAX_BATCH_SIZE}).',style='Chọn một phong cách nghệ thuật.',negative_prompt='Những thứ bạn KHÔNG muốn thấy trong ảnh.',aspect_ratio='Chọn tỷ lệ khung hình cho ảnh.',guidance_scale='Mức độ bám sát prompt (thấp = sáng tạo, cao = bám sát).')
+async def batch_command(interaction: discord.Interaction, prompts: str, style: Literal["Không có", "Anime", "Thực tế (Realistic)", "Cyberpunk", "Fantasy", "Tranh sơn dầu"] = "Không có", aspect_ratio: Literal["1:1 (Vuông)", "3:4 (Dọc)", "4:3 (Ngang)", "16:9 (Màn ảnh rộng)", "9:16 (Story)"] = "1:1 (Vuông)", negative_prompt: str = None, guidance_scale: app_commands.Range[float, 1.0, 10.0] = 7.5):
+    await interaction.response.defer(ephemeral=True)
+    if not account_manager.accounts: await interaction.followup.send("❌ Bot chưa được cấu hình."); return
+    prompt_list = [p.strip() for p in prompts.split(';') if p.strip()]
+    if not prompt_list: await interaction.followup.send("❌ Bạn chưa nhập prompt nào."); return
+    if len(prompt_list) > Config.MAX_BATCH_SIZE: await interaction.followup.send(f"❌ Mỗi lô chỉ được tối đa {Config.MAX_BATCH_SIZE} prompt."); return
+    if (error := bot.generation_queue.admission_error(interaction.user.id, privileged=interaction.user.id == Config.OWNER_ID)): await interaction.followup.send(f"❌ {error}"); return
+    job = {'interaction': interaction, 'batch': [{'prompt': p, 'style': style, 'negative_prompt': negative_prompt, 'size': ASPECT_RATIO_MAP[aspect_ratio], 'guidance_scale': guidance_scale, 'seed': variant_seed(-1, i)} for i, p in enumerate(prompt_list)], 'enqueued_at': time.monotonic()}
+    position, eta = await bot.enqueue(job)
+    await interaction.followup.send(f"✅ Lô {len(prompt_list)} ảnh của bạn đã vào hàng đợi ở vị trí **#{position}**, dự kiến xong sau khoảng **{format_duration(eta)}**.")
 
 @bot.tree.command(name='queue', description='Xem hàng đợi tạo ảnh hiện tại.')
 async def queue_command(interaction: discord.Interaction):
     queue_size = bot.generation_queue.qsize()
     embed = discord.Embed(title="🎨 Hàng đợi tạo ảnh", color=discord.Color.gold())
-    if bot.current_job_user: embed.add_field(name="▶️ Đang xử lý", value=f"Yêu cầu của **{bot.current_job_user.display_name}**", inline=False)
+    if bot.active_jobs:
+        running = [f"`#{job_id}` **{j['user'].display_name}** — {j['account'] or 'đang chuẩn bị'} ({int(time.monotonic() - j['started_at'])}s)" for job_id, j in sorted(bot.active_jobs.items())]
+        embed.add_field(name=f"▶️ Đang xử lý ({len(running)})", value="\n".join(running)[:1024], inline=False)
     else: embed.add_field(name="▶️ Đang xử lý", value="Không có yêu cầu nào.", inline=False)
-    embed.add_field(name="⏳ Đang chờ", value=f"Có **{queue_size}** yêu cầu khác trong hàng đợi.", inline=False)
+    waiting_users = len({user_id for users in bot.generation_queue.lanes.values() for user_id in users})
+    embed.add_field(name="⏳ Đang chờ", value=f"Có **{queue_size}** yêu cầu của **{waiting_users}** người dùng trong hàng đợi (chia lượt công bằng giữa mọi người).", inline=False)
+    mine = [f"`#{position}` {len(job['batch']) if 'batch' in job else 1} ảnh — xong sau khoảng **{format_duration(eta)}**" for job, position, eta in bot.generation_queue.estimates(len(bot.workers)) if job['interaction'].user.id == interaction.user.id]
+    if mine: embed.add_field(name="🙋 Yêu cầu của bạn", value="\n".join(mine)[:1024], inline=False)
+    if (stats := bot.poller.stats())['samples']: embed.set_footer(text=f"Thời gian tạo ảnh: p50 {stats['p50']:.1f}s | p95 {stats['p95']:.1f}s ({stats['samples']} mẫu)")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name='points', description='(Chủ bot) Kiểm tra điểm của tất cả các tài khoản.')
@@ -277,23 +940,45 @@ async def queue_command(interaction: discord.Interaction):
 async def points_command(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
     if not account_manager.accounts: await interaction.followup.send("⚠️ Không có tài khoản nào được cấu hình."); return
+    await account_manager.refresh_points(bot.get_points, force=True)
     embed = discord.Embed(title="💎 Tình trạng điểm các tài khoản", color=0x00FF88)
     total_points = 0
     for i, acc in enumerate(account_manager.accounts):
-        result = await bot.get_points(acc)
-        status, points = ("✅", result.get('points', 0)) if result.get('success') else ("❌", f"Lỗi: {result.get('error')}")
+        entry = account_manager.points.get(account_manager.account_key(acc), {})
+        status, points = ("✅", entry.get('points', 0)) if not entry.get('error') else ("❌", f"Lỗi: {entry.get('error')}")
         if isinstance(points, int): total_points += points
         is_current = " (hiện tại)" if i == account_manager.current_index else ""
         embed.add_field(name=f"{status} {acc.get('description', f'Tài khoản #{i+1}')}{is_current}", value=f"Điểm: **{points:,}**" if isinstance(points, int) else points, inline=False)
     embed.set_footer(text=f"Tổng số điểm khả dụng: {total_points:,}")
     await interaction.followup.send(embed=embed)
 
+@bot.tree.command(name='stats', description='(Chủ bot) Xem số liệu hiệu năng của bot.')
+@is_owner()
+async def stats_command(interaction: discord.Interaction):
+    embed = discord.Embed(title="📈 Số liệu hiệu năng", color=discord.Color.blue())
+    embed.add_field(name="📬 Hàng đợi", value=f"Đang chờ: **{bot.generation_queue.qsize()}** | Đang xử lý: **{len(bot.active_jobs)}** | Đang poll: **{len(bot.poller.pending)}**", inline=False)
+    stages = [f"`{stage:<16}` p50 {st['p50']:.2f}s | p95 {st['p95']:.2f}s ({st['count']})" for stage, st in metrics.stage_summary().items()]
+    embed.add_field(name="⏱️ Thời gian từng bước", value="\n".join(stages)[:1024] or "Chưa có dữ liệu.", inline=False)
+    cache = prompt_cache.stats()
+    embed.add_field(name="💾 Bộ đệm", value=f"Trúng: **{cache['hits']}** (gần giống: {cache['similar_hits']}) | Trượt: **{cache['misses']}** | Tỷ lệ: **{cache['hit_rate']:.0%}** | Hết hạn: {cache['expired']}", inline=False)
+    images = {source: int(metrics.counter_total('vmos_images_total', source=source)) for source in ('generated', 'cache', 'shared', 'error')}
+    embed.add_field(name="🖼️ Ảnh", value=f"Tạo mới: **{images['generated']}** | Từ cache: **{images['cache']}** | Dùng chung: **{images['shared']}** | Lỗi: **{images['error']}**", inline=False)
+    errors = {}
+    for (name, labels), value in metrics.counters.items():
+        if name == 'vmos_api_errors_total': errors[dict(labels).get('account')] = errors.get(dict(labels).get('account'), 0) + value
+    names = {account_manager.account_key(acc): acc.get('description') for acc in account_manager.accounts}
+    embed.add_field(name="⚠️ Lỗi API theo tài khoản", value="\n".join(f"{names.get(k, k)}: **{v}**" for k, v in sorted(errors.items(), key=lambda kv: -kv[1]))[:1024] or "Không có lỗi.", inline=False)
+    embed.set_footer(text=f"Đổi tài khoản: {int(metrics.counter_total('vmos_account_switches_total'))} | Poll timeout: {bot.poller.timeouts} | /metrics: cổng {Config.METRICS_PORT or 'tắt'}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name='help', description='Hiển thị thông tin trợ giúp về bot.')
 async def help_command(interaction: discord.Interaction):
     embed = discord.Embed(title="🤖 Trợ giúp Bot VMOS AI", description="Một bot AI mạnh mẽ với đầy đủ tùy chọn chuyên nghiệp.", color=discord.Color.blue())
     embed.add_field(name="`/generate <prompt> [options...]`", value="Tạo ảnh AI với các tùy chọn nâng cao.", inline=False)
+    embed.add_field(name="`/batch <prompt 1; prompt 2; ...> [options...]`", value=f"Tạo tối đa {Config.MAX_BATCH_SIZE} ảnh cùng lúc, trả về trong một gallery.", inline=False)
     embed.add_field(name="`/queue`", value="Xem trạng thái hàng đợi hiện tại.", inline=False)
     embed.add_field(name="`/points`", value="(Chủ bot) Kiểm tra số điểm của tất cả tài khoản.", inline=False)
+    embed.add_field(name="`/stats`", value="(Chủ bot) Xem số liệu hiệu năng (thời gian từng bước, bộ đệm, lỗi API).", inline=False)
     embed.add_field(name="`/addaccount`", value="(Chủ bot) Thêm tài khoản VMOS mới.", inline=False)
     embed.add_field(name="`/editaccount`", value="(Chủ bot) Sửa thông tin tài khoản.", inline=False)
     embed.add_field(name="`/removeaccount`", value="(Chủ bot) Xóa tài khoản.", inline=False)
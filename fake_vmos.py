@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Server giả lập API VMOS (`/images/generation`, `/images/status/{id}`, `/imagesUser/userInfo`) để đo hiệu năng bot mà không tốn điểm thật."""
+import argparse, asyncio, itertools, json, logging, random, time
+from aiohttp import web
+
+logger = logging.getLogger('fake_vmos')
+API_PREFIX = '/vcpcloud/api'
+
+# Mỗi profile: độ trễ mỗi request, thời gian tạo ảnh (trung bình/độ lệch), tỷ lệ lỗi và số điểm ban đầu của mỗi tài khoản.
+PROFILES = {
+    'fast': {'api_latency': 0.02, 'gen_time_mean': 2.0, 'gen_time_stdev': 0.5, 'generation_error_rate': 0.0, 'status_error_rate': 0.0, 'initial_points': 1000000},
+    'realistic': {'api_latency': 0.15, 'gen_time_mean': 12.0, 'gen_time_stdev': 3.0, 'generation_error_rate': 0.01, 'status_error_rate': 0.02, 'initial_points': 1000000},
+    'flaky': {'api_latency': 0.3, 'gen_time_mean': 12.0, 'gen_time_stdev': 5.0, 'generation_error_rate': 0.1, 'status_error_rate': 0.2, 'initial_points': 1000000},
+    'depleting': {'api_latency': 0.15, 'gen_time_mean': 12.0, 'gen_time_stdev': 3.0, 'generation_error_rate': 0.0, 'status_error_rate': 0.0, 'initial_points': 5000},
+}
+
+class FakeVMOS:
+    def __init__(self, profile='fast', time_scale=1.0, points_per_image=1000, seed=None):
+        self.profile = dict(PROFILES[profile]); self.time_scale = time_scale; self.points_per_image = points_per_image
+        self.random = random.Random(seed); self.tasks = {}; self.points = {}; self.task_ids = itertools.count(1); self.calls = {}
+    def app(self):
+        app = web.Application()
+        app.router.add_post(f'{API_PREFIX}/images/generation', self.handle_generation)
+        app.router.add_get(f'{API_PREFIX}/images/status/{{task_id}}', self.handle_status)
+        app.router.add_post(f'{API_PREFIX}/imagesUser/userInfo', self.handle_user_info)
+        app.router.add_get('/api-create.php', self.handle_shorten)
+        app.router.add_get('/_stats', self.handle_stats)
+        return app
+    async def delay(self, endpoint: str):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        await asyncio.sleep(self.profile['api_latency'] * self.time_scale)
+    def account_points(self, request): return self.points.setdefault(request.headers.get('userId'), self.profile['initial_points'])
+    def signed_url(self, task_id: str):
+        signed_at = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        # Dài hơn 512 ký tự như URL TOS thật, vượt giới hạn URL của nút link trên Discord
+        return f"https://fake-vmos.local/images/{task_id}.jpeg?X-Tos-Algorithm=TOS4-HMAC-SHA256&X-Tos-Credential={'A' * 60}%2F{signed_at[:8]}%2Fcn-beijing%2Ftos%2Frequest&X-Tos-Date={signed_at}&X-Tos-Expires=86400&X-Tos-Signature={'f' * 64}&X-Tos-SignedHeaders=host&x-tos-process={'W' * 280}"
+    async def handle_generation(self, request):
+        await self.delay('generation'); body = await request.json(); user_id = request.headers.get('userId')
+        if self.random.random() < self.profile['generation_error_rate']: return web.json_response({'code': 500, 'msg': 'Fake generation error'})
+        if self.account_points(request) < self.points_per_image: return web.json_response({'code': 500, 'msg': 'Insufficient points'})
+        self.points[user_id] -= self.points_per_image; task_id = f"fake-{next(self.task_ids)}"
+        duration = max(0.1, self.random.gauss(self.profile['gen_time_mean'], self.profile['gen_time_stdev'])) * self.time_scale
+        self.tasks[task_id] = {'done_at': time.monotonic() + duration, 'prompt': body.get('prompt')}
+        return web.json_response({'code': 200, 'data': {'taskId': task_id}})
+    async def handle_status(self, request):
+        await self.delay('status'); task = self.tasks.get(task_id := request.match_info['task_id'])
+        if self.random.random() < self.profile['status_error_rate']: return web.Response(status=502, text='Fake gateway error')
+        if not task: return web.json_response({'code': 404, 'msg': 'Task not found'})
+        if time.monotonic() < task['done_at']: return web.json_response({'code': 200, 'data': None})
+        return web.json_response({'code': 200, 'data': {'returnImage': json.dumps([self.signed_url(task_id)])}})
+    async def handle_user_info(self, request):
+        await self.delay('userInfo'); return web.json_response({'code': 200, 'data': {'remainingPoints': self.account_points(request)}})
+    async def handle_shorten(self, request):
+        await self.delay('shorten'); return web.Response(text=f"https://tiny.fake/{abs(hash(request.query.get('url', ''))) % 10 ** 8}")
+    async def handle_stats(self, request): return web.json_response({'calls': self.calls, 'points': self.points, 'tasks': len(self.tasks)})
+
+async def start_server(fake: FakeVMOS, host='127.0.0.1', port=0):
+    """Chạy server giả lập trong event loop hiện tại, trả về (runner, base URL của API)."""
+    runner = web.AppRunner(fake.app(), access_log=None); await runner.setup()
+    site = web.TCPSite(runner, host, port); await site.start()
+    bound_port = runner.addresses[0][1]
+    return runner, f"http://{host}:{bound_port}{API_PREFIX}"
+
+def main():
+    parser = argparse.ArgumentParser(description='Server giả lập API VMOS.')
+    parser.add_argument('--host', default='127.0.0.1'); parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='realistic'); parser.add_argument('--time-scale', type=float, default=1.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.info(f"🧪 Fake VMOS API ({args.profile}) tại http://{args.host}:{args.port}{API_PREFIX} — đặt VMOS_API_BASE_URL và SHORTENER_URL=http://{args.host}:{args.port}/api-create.php cho bot.")
+    web.run_app(FakeVMOS(args.profile, args.time_scale).app(), host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    main()